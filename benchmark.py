@@ -0,0 +1,221 @@
+''' Benchmarks of the data processing without visualization
+
+    Synthetic FE-I4 raw data is decoded, received via zmq and shown on a
+    headless telescope. Throughput and latency percentiles are reported per
+    stage, e.g.:
+
+        python benchmark.py --hits 100 --noise 1e-3 --json results.json
+'''
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import zmq
+import numpy as np
+
+import pybario
+import replay
+import simulation
+
+
+def random_raw_data(n_words, seed=0):
+    ''' Raw data of FE-I4 data records with random col, row and tot '''
+    rng = np.random.RandomState(seed)
+    cols = rng.randint(1, 81, n_words).astype(np.uint32)
+    rows = rng.randint(1, 337, n_words).astype(np.uint32)
+    tots = rng.randint(0, 14, n_words).astype(np.uint32)
+    return np.left_shift(cols, 17) | np.left_shift(rows, 8) | np.left_shift(tots, 4)
+
+
+def synthetic_readouts(n_readouts, n_hits=50, noise_occupancy=1e-4, seed=0):
+    ''' Raw data of n_readouts readouts
+
+        Every readout has a trigger word and a data header followed by on
+        average n_hits hits and noise_occupancy * 80 * 336 noise hits.
+    '''
+    rng = np.random.RandomState(seed)
+    n_pixels = pybario._N_COLS * pybario._N_ROWS
+    readouts = []
+    for i in range(n_readouts):
+        n_words = rng.poisson(n_hits) + rng.poisson(noise_occupancy * n_pixels)
+        header = np.array([0x80000000 | i, 0x00E90000 | ((i & 0x1F) << 10) | (i & 0x3FF)], dtype=np.uint32)
+        readouts.append(np.concatenate((header, random_raw_data(n_words, seed=seed + i + 1))))
+    return readouts
+
+
+def percentiles(latencies):
+    ''' Median, 90 % and 99 % latency in micro seconds '''
+    return dict(zip(('p50_us', 'p90_us', 'p99_us'), np.percentile(latencies, (50, 90, 99)) * 1e6))
+
+
+def timed(function, arguments):
+    ''' Latencies of function called with every element of arguments '''
+    latencies = np.empty(shape=len(arguments))
+    for i, argument in enumerate(arguments):
+        t_start = time.perf_counter()
+        function(argument)
+        latencies[i] = time.perf_counter() - t_start
+    return latencies
+
+
+def stage_result(latencies, n_hits):
+    result = dict(readouts_per_s=len(latencies) / latencies.sum(), hits_per_s=n_hits / latencies.sum())
+    result.update(percentiles(latencies))
+    return result
+
+
+def decode_benchmark(readouts, max_hits=100):
+    ''' Decoding of single readouts with the list and the array interfaces '''
+    n_hits = sum(pybario.col_row_array(words).shape[0] for words in readouts)
+    noise_hits = pybario.col_row_pairs(readouts[0], max_hits=max_hits, noise_hits=[])
+    noise_mask = pybario.noise_mask_from_hits(noise_hits)
+    return {
+        'col_row_pairs': stage_result(timed(lambda words: pybario.col_row_pairs(words, max_hits, noise_hits), readouts), n_hits),
+        'col_row_array': stage_result(timed(lambda words: pybario.col_row_array(words, max_hits, noise_mask), readouts), n_hits),
+        'cluster_hits': stage_result(timed(lambda words: pybario.cluster_hits(pybario.event_hit_array(words, noise_mask)[0]), readouts), n_hits)
+    }
+
+
+def io_benchmark(readouts, threaded=False, processes=False, address='inproc://io_benchmark'):
+    ''' IO.get_module_hits fetching readouts published on a local socket
+
+        The latency is measured per call that returned data, the readout
+        and hit rates from the wall clock time between the first send and
+        the last call that returned data. Decoder processes need an address
+        reachable from other processes (tcp).
+    '''
+    context = zmq.Context()
+    publisher = context.socket(zmq.PUB)
+    publisher.set_hwm(0)
+    publisher.bind(address)
+    io = pybario.IO(addresses=[address], threaded=threaded, processes=processes, context=context)
+    time.sleep(0.1)  # wait for subscription
+    t_first = time.perf_counter()
+    for words in readouts:
+        replay.send_data(publisher, (words, 0., 0., 0))
+    latencies, n_hits, t_last = [], 0, t_first
+    t_timeout = time.time() + 10.
+    while (io.n_received[0] < len(readouts) or io.n_queued[0]) and time.time() < t_timeout:
+        t_start = time.perf_counter()
+        hits = io.get_module_hits()[0]
+        if hits is not None:
+            t_last = time.perf_counter()
+            latencies.append(t_last - t_start)
+            n_hits += hits.shape[0]
+    n_received = io.n_received[0]
+    io.close()
+    publisher.close()
+    context.term()
+    result = stage_result(np.array(latencies), n_hits)
+    wall_time = t_last - t_first
+    result['readouts_per_s'] = n_received / wall_time if wall_time > 0 else 0.
+    result['hits_per_s'] = n_hits / wall_time if wall_time > 0 else 0.
+    return result
+
+
+def telescope_benchmark(n_readouts, n_frames=1000, dt=1 / 60., tracks_per_event=1.):
+    ''' Adding hits and tracks to a headless telescope and its update loop
+
+        The tracks of every readout are simulated for all planes.
+    '''
+    import pyglet
+    pyglet.options['shadow_window'] = False  # no display needed
+    import main
+
+    telescope = main.Telescope(headless=True)
+    plane_readouts = simulation.Simulation(z=[m.detector.z for m in telescope.modules],
+                                           rotations=[m.rotation for m in telescope.modules],
+                                           tracks_per_event=tracks_per_event, seed=0).readouts(n_readouts)
+    module_data = []
+    for readouts in zip(*plane_readouts):
+        module_hits, module_clusters = [], []
+        for words in readouts:
+            event_hits, triggers, bcids = pybario.event_hit_array(words)
+            clusters, _ = pybario.cluster_hits(event_hits)
+            clusters[:, 0] = pybario.event_keys(triggers, bcids)[clusters[:, 0].astype(np.intp)]
+            module_hits.append(event_hits[:, 1:])
+            module_clusters.append(clusters)
+        module_data.append((module_hits, module_clusters))
+    n_hits = sum(sum(h.shape[0] for h in module_hits) for module_hits, _ in module_data)
+    return {
+        'Telescope.add_module_hits': stage_result(timed(lambda data: telescope.add_module_hits(*data), module_data), n_hits),
+        'Telescope.update': stage_result(timed(telescope.update, [dt] * n_frames), 0)  # readouts are frames
+    }
+
+
+def copy_benchmark(n_readouts=100, n_words=100000, address='inproc://copy_benchmark'):
+    ''' Python heap bytes allocated per readout while receiving and decoding
+
+        Compares the copying receive path (zero_copy=False) with the zero
+        copy path. Returns a dict with the mean bytes per readout.
+    '''
+    context = zmq.Context()
+    publisher = context.socket(zmq.PUB)
+    publisher.set_hwm(0)
+    publisher.bind(address)
+    data = random_raw_data(n_words)
+    results = {}
+    for zero_copy in (False, True):
+        io = pybario.IO(addresses=[address], zero_copy=zero_copy, context=context)
+        time.sleep(0.1)  # wait for subscription
+        for _ in range(n_readouts):
+            replay.send_data(publisher, (data, 0., 0., 0))
+        socket = io.sockets[0]
+        recv_bytes, decode_bytes = 0, 0
+        tracemalloc.start()
+        for _ in range(n_readouts):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            words, _ = io._recv_message(socket)
+            recv_bytes += tracemalloc.get_traced_memory()[1] - current
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            io._decode(0, words, max_hits=io.max_hits)
+            decode_bytes += tracemalloc.get_traced_memory()[1] - current
+            del words
+        tracemalloc.stop()
+        io.close()
+        results['zero_copy' if zero_copy else 'copy'] = dict(receive=recv_bytes / n_readouts,
+                                                            decode=decode_bytes / n_readouts)
+    publisher.close()
+    context.term()
+    return results
+
+
+def print_results(results):
+    print('%-26s %12s %12s %10s %10s %10s' % ('stage', 'readouts/s', 'hits/s', 'p50 [us]', 'p90 [us]', 'p99 [us]'))
+    for stage, result in results.items():
+        print('%-26s %12.0f %12.0f %10.1f %10.1f %10.1f' % (stage, result['readouts_per_s'], result['hits_per_s'],
+                                                          result['p50_us'], result['p90_us'], result['p99_us']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data processing without a window')
+    parser.add_argument('--readouts', type=int, default=1000, help='number of readouts')
+    parser.add_argument('--hits', type=float, default=50, help='mean hits per readout')
+    parser.add_argument('--noise', type=float, default=1e-4, help='noise occupancy per pixel and readout')
+    parser.add_argument('--json', help='write the results to this json file')
+    parser.add_argument('--no-telescope', action='store_true', help='skip the visualization benchmarks (needs pyglet)')
+    args = parser.parse_args()
+
+    readouts = synthetic_readouts(args.readouts, n_hits=args.hits, noise_occupancy=args.noise)
+    results = decode_benchmark(readouts)
+    results['IO.get_module_hits'] = io_benchmark(readouts)
+    results['IO threaded'] = io_benchmark(readouts, threaded=True)
+    results['IO decoder process'] = io_benchmark(readouts, threaded=True, processes=True,
+                                                 address='tcp://127.0.0.1:5700')
+    if not args.no_telescope:
+        results.update(telescope_benchmark(args.readouts))
+    print_results(results)
+
+    n_words = 100000
+    print('\nBytes copied per readout of %d words (%d bytes raw data)' % (n_words, n_words * 4))
+    copies = copy_benchmark(n_words=n_words)
+    for path, result in copies.items():
+        print('%10s: receive %10.0f, decode %10.0f' % (path, result['receive'], result['decode']))
+
+    if args.json:
+        with open(args.json, 'w') as out_file:
+            json.dump(dict(config=vars(args), results=results, copies=copies), out_file, indent=2)
@@ -1,15 +1,29 @@
+import argparse
+import collections
+import csv
+import json
 import math
 import random
 import sys
 import os
+import time
 from itertools import chain
 
+import numpy as np
+
+import pyglet
 from pyglet.gl import *
 from pyglet.window import key
 
 import pybario
+import renderer
 
 script_dir = os.path.dirname(__file__)
+_GEOMETRY_FILE = os.path.join(script_dir, 'geometry.json')
+pyglet.resource.path = [os.path.join(script_dir, 'media')]
+pyglet.resource.reindex()
+_image_data = {}
+_sounds = {}
 
 
 def pix_idx_to_pos(col, row, detector):
@@ -19,153 +33,429 @@ def pix_idx_to_pos(col, row, detector):
 
 _MAX_HITS = 10  # maximum hits to visualize, new hits delete old
 _MAX_TRACKS = 3  # maximum hits to visualize, new tracks are only drawn when old ones faded out
-_COMBINE_N_READOUTS = 20
+_PROCESS_INTERVAL = 0.01  # seconds between data processing calls, independent of the frame rate
+_COMBINE_TIME = 0.33  # seconds of data combined to find tracks
+_COMBINE_READOUT_TIME = False  # measure the combine time with the readout timestamps instead of the wall clock
+_TIME_COINCIDENCE = True  # find tracks only in readouts of all modules with overlapping time windows
+_REORDER_WINDOW = 1.  # seconds of readout time a lagging module is waited for
+_THREADED_IO = True  # receive and decode data in a background thread
+_ASYNC_IO = False  # receive with asyncio (pybario_asyncio), in a thread or stepped by the pyglet clock
+_CLUSTER_HITS = True  # show cluster centroids instead of single pixels
+_DECODER_PROCESSES = False  # decode every module in its own process, for high rates with many modules
+_READOUT_POLICY = 'all'  # decode 'all', the 'latest' or a 'sample' of the readouts if the display falls behind
+_SAMPLE_EVERY = 10  # readouts per decoded readout with the 'sample' policy
+_RCVHWM = 100  # readouts queued by zmq per module, older data is not shown minutes late
 _CLEAR_COLOR = (0.87, 0.87, 0.87, 1)
+_HIT_SIZE = 1.5
+_HIT_FADE_SPEED = 50  # transparency increase per second
+_TRACK_FADE_SPEED = 1
+_TRACK_MAX_TRANSPARENCY = 200  # tracks do not fade out completely
+_STATS_INTERVAL = 1.  # seconds over which the performance statistics are averaged
+_STATS_STAGES = ('aggregation', 'update', 'draw')  # timed stages of the application
+_SHADER_RENDERING = True  # instanced drawing with fading on the GPU (renderer) if OpenGL 3.3 is available
+_SHADER_MAX_HITS = 20000  # hits per module shown with shader rendering, for long exposures
+_HEATMAP = False  # show the accumulated hits of every pixel and the track angle histogram
+_ANGLE_BINS = 20  # bins of the track angle histogram
 
 
-class Hit(object):
-    dx, dy = 1.5, 1.5
+def load_geometry(geometry_file):
+    ''' Modules of the telescope from a json geometry file
 
-    def __init__(self, x, y):
-        self.x = x - self.dx
-        self.y = y + self.dy
-        self.transparency = 100
+        Every module has the zmq address of its pyBAR data, the z position
+        (mm), an optional clockwise rotation around the beam axis in
+        degree and an optional noise mask file (npz, see pybario.NoiseMask).
+    '''
+    with open(geometry_file) as in_file:
+        modules = json.load(in_file)['modules']
+    for module in modules:
+        module.setdefault('rotation', 0.)
+        module.setdefault('noise_mask', None)
+    return modules
 
-    def update(self, dt):
-        # Fade out hit
-        self.transparency += dt * 50
-        if self.transparency > 255:
-            return False
-        return True
 
-    def draw(self):
-        X, Y, Z = self.x + self.dx, self.y + self.dy, 3.
-        alpha = 255 - int(self.transparency)
-        pyglet.graphics.draw(4, GL_QUADS, ('v3f', (self.x, self.y, Z, X, self.y, Z, X, Y, Z, self.x, Y, Z)),
-                             ('c4B', (255, 0, 0, alpha,
-                                      255, 0, 0, alpha,
-                                      255, 0, 0, alpha,
-                                      255, 0, 0, alpha)))
-
-
-class Track(object):
-    dx, dy = 1.5, 1.5
-
-    def __init__(self, p1, p2):
-        self.p1 = p1
-        self.p2 = p2
-        direction = (p1[0] - p2[0], p1[1] - p2[1], p1[2] - p2[2])
-        position = p1
-        self.track_start = (position[0] - 1000 * direction[0], position[1] - 1000 * direction[1], position[2] - 1000 * direction[2])
-        self.track_stop = (position[0] + 1000 * direction[0], position[1] + 1000 * direction[1], position[2] + 1000 * direction[2])
-        self.transparency = 100
+def readout_batches(module_readouts):
+    ''' Shown hits and timestamps of decoded readouts like pybario.IO.get_module_batches
+
+        Per readout at most _MAX_HITS hits (cluster centroids with
+        _CLUSTER_HITS) are shown, e.g. of the readouts of a recording.
+    '''
+    mh, timestamps = [], []
+    for readouts in module_readouts:
+        if not readouts:
+            mh.append(None)
+            timestamps.append(None)
+            continue
+        mh.append(np.concatenate([r.clusters[:_MAX_HITS, 1:] if _CLUSTER_HITS else r.hits[:_MAX_HITS] for r in readouts]))
+        timestamps.append(np.array([r.timestamp for r in readouts], dtype=np.float64))
+    return mh, timestamps
+
+
+def readout_hit_counts(module_readouts):
+    ''' Hits per pixel of decoded readouts like pybario.IO.get_module_hit_counts '''
+    return [pybario.hit_counts(np.concatenate([r.hits for r in readouts])) if readouts else None
+            for readouts in module_readouts]
+
+
+def media_image(name, texture=True):
+    ''' Image of the media folder that is loaded from disk only once
+
+        Textures are shared by the pyglet resource loader (small images are
+        packed into one texture atlas). Without texture the image data is
+        returned, this needs no OpenGL context.
+    '''
+    if texture:
+        return pyglet.resource.image(name)
+    if name not in _image_data:
+        _image_data[name] = pyglet.image.load(os.path.join(script_dir, 'media', name))
+    return _image_data[name]
+
+
+def play_sound(name):
+    ''' Play a sound of the media folder, sounds are loaded when played first '''
+    if name not in _sounds:
+        _sounds[name] = pyglet.resource.media(name, streaming=False)
+    _sounds[name].play()
+
+
+def quad_vertices(x, y, z, dx, dy):
+    ''' Vertices (N, 4, 3) of quads [x, x + dx] x [y, y + dy] at height z, dx and dy can be arrays '''
+    vertices = np.empty(shape=(len(x), 4, 3), dtype=np.float32)
+    vertices[:, :, 0] = np.asarray(x)[:, np.newaxis]
+    vertices[:, :, 1] = np.asarray(y)[:, np.newaxis]
+    vertices[:, :, 2] = np.asarray(z)[:, np.newaxis]
+    vertices[:, 1:3, 0] += np.asarray(dx)[..., np.newaxis]
+    vertices[:, 2:4, 1] += np.asarray(dy)[..., np.newaxis]
+    return vertices
+
+
+def heatmap_colors():
+    ''' Color table (256, 4) from transparent (no hits) over yellow to red '''
+    levels = np.linspace(0., 1., 256)
+    colors = np.empty(shape=(256, 4), dtype=np.uint8)
+    colors[:, 0] = 255
+    colors[:, 1] = 255 * (1. - levels)
+    colors[:, 2] = 0
+    colors[:, 3] = 128 + 127 * levels
+    colors[0, 3] = 0
+    return colors
+
+
+_HEATMAP_COLORS = heatmap_colors()
+
+
+class VertexBuffer(object):
+    ''' Persistent vertex list for a fixed number of equally colored objects
+
+        The geometry is only written when the objects change, per frame
+        only the alpha values are updated. Hidden objects are degenerated
+        to a point and thus not drawn.
+    '''
+
+    def __init__(self, n_objects, n_vertices, mode, color, batch):
+        self.n_objects = n_objects
+        self.n_vertices = n_vertices  # vertices per object
+        colors = (tuple(color) + (0, )) * (n_objects * n_vertices)
+        self.vertex_list = batch.add(n_objects * n_vertices, mode, None, 'v3f/dynamic', ('c4B/stream', colors))
+
+    def set_vertices(self, vertices, visible=None):
+        ''' Set the (N, n_vertices, 3) vertices of the first N objects, hide the others
+
+            Objects where the boolean array visible is False are hidden too.
+        '''
+        vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, self.n_vertices, 3)
+        buffer_vertices = np.ctypeslib.as_array(self.vertex_list.vertices).reshape(self.n_objects, self.n_vertices, 3)
+        buffer_vertices[:len(vertices)] = vertices
+        buffer_vertices[len(vertices):] = 0.
+        if visible is not None:
+            buffer_vertices[:len(visible)][~visible] = 0.
+
+    def set_alpha(self, alpha):
+        ''' Set the alpha values of the first N objects '''
+        colors = np.ctypeslib.as_array(self.vertex_list.colors).reshape(self.n_objects, self.n_vertices, 4)
+        colors[:len(alpha), :, 3] = np.asarray(alpha)[:, np.newaxis]
+
+
+class FadingStore(object):
+    ''' Fixed size ring buffer of fading objects stored as arrays
+
+        New objects overwrite the oldest ones. Fading, expiry and eviction
+        are single array operations. Objects can carry an integer key
+        (e.g. the pixel index) to find duplicates with a lookup table of
+        n_keys entries.
+    '''
+
+    def __init__(self, size, shape, fade_speed, max_transparency=None, n_keys=0):
+        self.size = size
+        self.fade_speed = fade_speed
+        self.max_transparency = max_transparency
+        self.positions = np.zeros(shape=(size, ) + tuple(shape), dtype=np.float32)
+        self.transparency = np.full(shape=size, fill_value=256., dtype=np.float32)
+        self.alive = np.zeros(shape=size, dtype=bool)
+        self.keys = np.full(shape=size, fill_value=-1, dtype=np.int64)
+        self.occupied = np.zeros(shape=n_keys, dtype=bool)  # key lookup table
+        self.index = 0  # ring position of the oldest object
+        self.changed = True  # positions or alive objects changed
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    def _release_keys(self, slots):
+        keys = self.keys[slots]
+        self.occupied[keys[keys >= 0]] = False
+        self.keys[slots] = -1
+
+    def contains(self, keys):
+        ''' Boolean array, True for keys of alive objects '''
+        return self.occupied[keys]
+
+    def add(self, positions, keys=None):
+        ''' Add objects, the oldest ones are overwritten if the store is full '''
+        positions = np.asarray(positions, dtype=np.float32)[-self.size:]
+        n = positions.shape[0]
+        if not n:
+            return
+        slots = (self.index + np.arange(n)) % self.size
+        self._release_keys(slots)
+        if keys is not None:
+            keys = np.asarray(keys)[-self.size:]
+            self.keys[slots] = keys
+            self.occupied[keys] = True
+        self.positions[slots] = positions
+        self.transparency[slots] = 100
+        self.alive[slots] = True
+        self.index = (self.index + n) % self.size
+        self.changed = True
+
+    def last(self):
+        ''' Position of the newest alive object, None if there is none '''
+        slots = (self.index - 1 - np.arange(self.size)) % self.size  # newest first
+        alive = np.flatnonzero(self.alive[slots])
+        if not alive.shape[0]:
+            return None
+        return self.positions[slots[alive[0]]]
 
     def update(self, dt):
-        # Fade out hit
-        self.transparency += dt * 1
-        if self.transparency > 200:
-            self.transparency = 200
-        if self.transparency > 255:
-            return False
-        return True
+        self.transparency += dt * self.fade_speed
+        if self.max_transparency is not None:
+            np.minimum(self.transparency, self.max_transparency, out=self.transparency)
+        expired = self.alive & (self.transparency > 255)
+        if expired.any():
+            self.alive[expired] = False
+            self._release_keys(expired)
+            self.changed = True
+
+    def clear(self):
+        self._release_keys(self.alive)
+        self.alive[:] = False
+        self.changed = True
+
+    def alpha(self):
+        return np.clip(255 - self.transparency, 0, 255).astype(np.uint8)
 
-    def draw(self):
-        alpha = 255 - int(self.transparency)
-        # Show track
-        pyglet.graphics.draw(2, GL_LINES, ('v3f', (self.track_start[0], self.track_start[1], self.track_start[2],
-                                                   self.track_stop[0], self.track_stop[1], self.track_stop[2])),
-                             ('c4B', (0, 128, 187, alpha, 0, 128, 187, alpha)))
-        # Show track hits too
-        alpha = 255
-        x, y = self.p1[0], self.p1[1]
-        X, Y, Z = self.p1[0] + self.dx, self.p1[1] + self.dy, self.p1[2] + 3.
-        pyglet.graphics.draw(4, GL_QUADS, ('v3f', (x, y, Z, X, y, Z, X, Y, Z, x, Y, Z)),
-                             ('c4B', (255, 0, 0, alpha,
-                                      255, 0, 0, alpha,
-                                      255, 0, 0, alpha,
-                                      255, 0, 0, alpha)))
-        x, y = self.p2[0], self.p2[1]
-        X, Y, Z = self.p2[0] + self.dx, self.p2[1] + self.dy, self.p2[2] + 3.
-        pyglet.graphics.draw(4, GL_QUADS, ('v3f', (x, y, Z, X, y, Z, X, Y, Z, x, Y, Z)),
-                             ('c4B', (255, 0, 0, alpha,
-                                      255, 0, 0, alpha,
-                                      255, 0, 0, alpha,
-                                      255, 0, 0, alpha)))
+
+class Sensor(object):
+    ''' Size and position of a module sensor without a sprite (headless mode) '''
+
+    def __init__(self, image, scale, z):
+        self.width = image.width * scale
+        self.height = image.height * scale
+        self.z = z
 
 
 class Module(object):
-    ''' Single module of the telescope '''
+    ''' Single module of the telescope
 
-    def __init__(self, x, y, z):
-        detector_image = pyglet.image.load(os.path.join(script_dir, 'media', 'SC.png'))
-        detector = pyglet.sprite.Sprite(detector_image, x=x, y=y, subpixel=True)
-        detector.scale = 0.1
-        detector.rotation = 180
-        detector.x += detector.width / 2.
-        detector.y += detector.height / 2.
-        detector.z = z
+        The hit counts per pixel (see add_hit_counts) are shown as heatmap
+        texture on the sensor. A headless module needs no OpenGL context
+        and cannot be drawn.
+    '''
+
+    def __init__(self, x, y, z, rotation=0., headless=False):
+        if headless:
+            detector = Sensor(media_image('SC.png', texture=False), scale=0.1, z=z)
+        else:
+            # Rotate around the image center
+            detector_image = media_image('SC.png')
+            detector_image.anchor_x = detector_image.width // 2
+            detector_image.anchor_y = detector_image.height // 2
+            detector = pyglet.sprite.Sprite(detector_image, x=x, y=y, subpixel=True)
+            detector.scale = 0.1
+            detector.rotation = 180 + rotation
+            detector.z = z
 
         self.detector = detector
-        self.hits = []
+        self.rotation = rotation
+        self._rotation_matrix = pybario.rotation_matrices([rotation])[0]
+        self.headless = headless
+        shader = not headless and _SHADER_RENDERING and renderer.supported()
+        max_hits = _SHADER_MAX_HITS if shader else _MAX_HITS
+        # Hit quad corners (x, y), keyed by pixel index
+        self.hits = FadingStore(max_hits, (2, ), _HIT_FADE_SPEED, n_keys=pybario._N_COLS * pybario._N_ROWS)
+        self.hit_counts = np.zeros(shape=(pybario._N_COLS, pybario._N_ROWS), dtype=np.int64)
+        self.heatmap_changed = True
 
-        pix_idc = [(0, 0), (0, 335), (79, 0), (79, 336)]
-        for col, row in pix_idc:
-            x, y = pix_idx_to_pos(col, row, detector)
-            self.hits.append(Hit(x, y))
+        self.hit_renderer = None  # fading is computed by the shader, otherwise in the vertex list
+        if shader:
+            self.hit_renderer = renderer.InstancedQuads(max_hits, (255, 0, 0), _HIT_FADE_SPEED, _HIT_SIZE)
+        elif not headless:
+            self.batch = pyglet.graphics.Batch()
+            self.hit_buffer = VertexBuffer(max_hits, 4, GL_QUADS, (255, 0, 0), self.batch)
+        if not headless:
+            # Texture of the pixel matrix with the pixel centers at the hit quad centers
+            self.heatmap = pyglet.image.Texture.create(pybario._N_COLS, pybario._N_ROWS, min_filter=GL_NEAREST,
+                                                       mag_filter=GL_NEAREST)
+            corners = self.hit_positions(np.array([(0.5, 0.5), (80.5, 0.5), (80.5, 336.5), (0.5, 336.5)])) + _HIT_SIZE / 2.
+            self.heatmap_batch = pyglet.graphics.Batch()
+            self.heatmap_batch.add(4, GL_QUADS, pyglet.graphics.TextureGroup(self.heatmap),
+                                   ('v3f', np.column_stack((corners, np.full(4, 2.))).ravel().tolist()),
+                                   ('t3f', self.heatmap.tex_coords))
+
+        pix_idc = np.array([(0, 0), (0, 335), (79, 0), (79, 336)])
+        self._add(self.hit_positions(pix_idc))
+
+    def hit_positions(self, hits):
+        positions = np.column_stack(pix_idx_to_pos(hits[:, 0], hits[:, 1], self.detector))
+        positions = positions.dot(self._rotation_matrix.T)
+        return positions + (-_HIT_SIZE, _HIT_SIZE)
+
+    def _add(self, positions, keys=None):
+        self.hits.add(positions, keys)
+        if self.hit_renderer is not None:
+            self.hit_renderer.add(np.column_stack((positions, np.full(positions.shape[0], 3.))))
 
     def add_hits(self, hits):
-        if not hits:
+        if hits is None or not len(hits):
             return False
-        added_hits = False
-        for i, (col, row) in enumerate(hits):
-            x, y = pix_idx_to_pos(col, row, self.detector)
-            # Do not add existing hits
-            for hit in self.hits:
-                if abs(x - hit.x - hit.dx) < 0.1 and abs(y - (hit.y - hit.dy)) < 0.1:
-                    break
-            else:
-                if len(self.hits) < _MAX_HITS:
-                    self.hits.append(Hit(x, y))
-                    added_hits = True
-                elif i < _MAX_HITS:
-                    self.hits.pop(0)
-                    self.hits.append(Hit(x, y))
-                    added_hits = True
-                else:
-                    break
-        return added_hits
+        hits = np.asarray(hits).reshape(-1, 2)
+        # Cluster centroids are keyed by their nearest pixel
+        keys = pybario.pixel_keys(np.rint(hits).astype(np.int64))
+        # Do not add existing hits
+        _, first = np.unique(keys, return_index=True)
+        first.sort()
+        first = first[~self.hits.contains(keys[first])][:self.hits.size]
+        if not first.shape[0]:
+            return False
+        self._add(self.hit_positions(hits[first]), keys[first])
+        return True
+
+    def add_hit_counts(self, counts):
+        ''' Add hits per pixel indexed by the pixel keys, e.g. of pybario.IO.get_module_hit_counts '''
+        if counts is None:
+            return
+        self.hit_counts += counts.reshape(self.hit_counts.shape)
+        self.heatmap_changed = True
 
     def update(self, dt):
-        for i in range(len(self.hits) - 1, -1, -1):
-            if not self.hits[i].update(dt):
-                del self.hits[i]
+        self.hits.update(dt)
+        if self.hit_renderer is not None:
+            self.hit_renderer.update(dt)
 
-    def draw(self):
+    def reset(self):
+        self.hits.clear()
+        if self.hit_renderer is not None:
+            self.hit_renderer.clear()
+        self.hit_counts[:] = 0
+        self.heatmap_changed = True
+
+    def draw_heatmap(self):
+        ''' Draw the hit counts, the texture is only uploaded if they changed '''
+        if self.heatmap_changed:
+            # Logarithmic color scale, image rows are the pixel rows
+            levels = np.log1p(self.hit_counts.T)
+            levels *= 255. / max(levels.max(), 1.)
+            colors = _HEATMAP_COLORS[levels.astype(np.uint8)]
+            self.heatmap.blit_into(pyglet.image.ImageData(pybario._N_COLS, pybario._N_ROWS, 'RGBA', colors.tobytes()),
+                                   0, 0, 0)
+            self.heatmap_changed = False
+        self.heatmap_batch.draw()
+
+    def draw(self, heatmap=False):
+        if self.hit_renderer is not None:
+            glTranslatef(0., 0., self.detector.z)
+            self.detector.draw()
+            if heatmap:
+                self.draw_heatmap()
+            self.hit_renderer.draw()
+            glTranslatef(0., 0., -self.detector.z)
+            return
+        if self.hits.changed:
+            positions = self.hits.positions
+            self.hit_buffer.set_vertices(quad_vertices(positions[:, 0], positions[:, 1], np.full(self.hits.size, 3.),
+                                                       _HIT_SIZE, _HIT_SIZE), visible=self.hits.alive)
+            self.hits.changed = False
+        self.hit_buffer.set_alpha(self.hits.alpha())
         glTranslatef(0., 0., self.detector.z)
         self.detector.draw()
-        for hit in self.hits:
-            hit.draw()
+        if heatmap:
+            self.draw_heatmap()
+        self.batch.draw()
         glTranslatef(0., 0., -self.detector.z)
 
 
 class Telescope(object):
-    ''' Visualization of a pixel telesecope '''
+    ''' Visualization of a pixel telesecope
 
-    def __init__(self, x=0, y=0, z=0):
+        The modules are given by the geometry (see load_geometry), default
+        is the geometry.json file. The polar angles of all tracks are
+        counted in angle_counts with the bin edges angle_edges (rad). A
+        headless telescope needs no OpenGL context and cannot be drawn. If
+        recorder is set (see recording.Recorder) the found tracks are
+        recorded.
+    '''
+
+    def __init__(self, x=0, y=0, z=0, geometry=None, headless=False):
         self.rotation = 0  # telescope rotation
         self.rot_speed = 20
+        self.headless = headless
 
+        if geometry is None:
+            geometry = load_geometry(_GEOMETRY_FILE)
         self.modules = []
-        self.modules.append(Module(x, y, 0))
-        self.modules.append(Module(x, y, 40))
+        for module in geometry:
+            self.modules.append(Module(x, y, z + module['z'], rotation=module['rotation'], headless=headless))
+        # Module z positions are taken as mm
+        self.track_finder = pybario.TrackFinder(z=[m.detector.z for m in self.modules],
+                                                rotations=[m.rotation for m in self.modules])
+        self.angle_edges = np.linspace(0., self.track_finder.max_angle, _ANGLE_BINS + 1)
+        self.angle_counts = np.zeros(shape=_ANGLE_BINS, dtype=np.int64)
+        self.show_heatmap = _HEATMAP
+
+        # Two track points (x, y, z) per track
+        self.tracks = FadingStore(_MAX_TRACKS, (2, 3), _TRACK_FADE_SPEED, max_transparency=_TRACK_MAX_TRANSPARENCY)
+        self.track_renderer = None  # fading is computed by the shader, otherwise in the vertex lists
+        if not headless and _SHADER_RENDERING and renderer.supported():
+            self.track_renderer = renderer.InstancedLines(_MAX_TRACKS, (0, 128, 187), _TRACK_FADE_SPEED,
+                                                          max_transparency=_TRACK_MAX_TRANSPARENCY)
+            self.track_hit_renderer = renderer.InstancedQuads(2 * _MAX_TRACKS, (255, 0, 0), 0, _HIT_SIZE, transparency=0)
+        elif not headless:
+            self.batch = pyglet.graphics.Batch()
+            self.track_buffer = VertexBuffer(_MAX_TRACKS, 2, GL_LINES, (0, 128, 187), self.batch)
+            self.track_hit_buffer = VertexBuffer(2 * _MAX_TRACKS, 4, GL_QUADS, (255, 0, 0), self.batch)
 
-        self.tracks = []
-        
-        self.hit_sound = pyglet.media.load(os.path.join(script_dir, 'media', 'hit.wav'), streaming=False)
-        self.track_sound = pyglet.media.load(os.path.join(script_dir, 'media', 'track.wav'), streaming=False)
         self.play_sounds = 0
+        self.recorder = None
+
+    def module_last_hit(self, i):
+        ''' Position (x, y, z) of the newest hit of module i '''
+        position = self.modules[i].hits.last()
+        if position is None:
+            raise IndexError('No hits in module %d' % i)
+        return (position[0], position[1], self.modules[i].detector.z)
 
-    def add_module_hits(self, module_hits):
+    def _add_tracks(self, points):
+        ''' Add tracks given by (N, 2, 3) points '''
+        points = np.asarray(points, dtype=np.float32)
+        self.tracks.add(points)
+        if self.track_renderer is not None:
+            self.track_renderer.add(points[:, 0], points[:, 1])
+            self.track_hit_renderer.add(points.reshape(-1, 3) + (0., 0., 3.))
+
+    def add_module_hits(self, module_hits, module_clusters=None, readout_time=None):
+        ''' Show new hits and the tracks found in the clusters of all modules
+
+            readout_time (start, stop) of the readouts is only recorded with
+            the tracks.
+        '''
         has_hits = []
         for i, one_module_hits in enumerate(module_hits):
             if one_module_hits is not None:
@@ -173,26 +463,26 @@ class Telescope(object):
             else:
                 has_hits.append(False)
         if self.play_sounds > 1 and any(has_hits):
-            self.hit_sound.play()
-        # Print a track if all modules are hit in this readout
-        # Only print one track candidate if many tracks are possible
-        try:
-            if all(has_hits):
-                hit_1 = (self.modules[0].hits[-1].x, self.modules[0].hits[-1].y, self.modules[0].detector.z)
-                hit_2 = (self.modules[1].hits[-1].x, self.modules[1].hits[-1].y, self.modules[1].detector.z)
-                if len(self.tracks) < _MAX_TRACKS:
-                    self.tracks.append(Track(hit_1, hit_2))
-                else:
-                    self.tracks.pop(0)
-                    self.tracks.append(Track(hit_1, hit_2))
-                glClearColor(0.95, 0.95, 0.95, 1)
-                def reset_background(_):
-                        glClearColor(*_CLEAR_COLOR)
-                pyglet.clock.schedule_once(reset_background, 0.1)
-                if self.play_sounds:
-                    self.track_sound.play()
-        except IndexError:
-            pass
+            play_sound('hit.wav')
+        tracks, chi2, angles = None, None, None
+        if module_clusters is not None:
+            tracks, chi2, angles = self.track_finder.find_tracks(module_clusters)
+        if self.recorder is not None:
+            self.recorder.record_tracks(tracks, chi2, angles, readout_time=readout_time)
+        if tracks is None or not tracks.shape[0]:
+            return
+        self.angle_counts += np.histogram(angles, bins=self.angle_edges)[0]
+        # Show the newest tracks of time coincident clusters in all modules
+        tracks = tracks[-_MAX_TRACKS:]
+        points = [np.column_stack((m.hit_positions(tracks[:, i]), np.full(tracks.shape[0], m.detector.z))) for i, m in enumerate(self.modules)]
+        self._add_tracks(np.stack((points[0], points[-1]), axis=1))
+        if not self.headless:
+            glClearColor(0.95, 0.95, 0.95, 1)
+            def reset_background(_):
+                    glClearColor(*_CLEAR_COLOR)
+            pyglet.clock.schedule_once(reset_background, 0.1)
+        if self.play_sounds:
+            play_sound('track.wav')
 
     def update(self, dt):
         self.rotation += dt * self.rot_speed
@@ -200,30 +490,55 @@ class Telescope(object):
             self.rotation -= 360
         for m in self.modules:
             m.update(dt)
-        for i in range(len(self.tracks) - 1, -1, -1):
-            if not self.tracks[i].update(dt):
-                del self.tracks[i]
+        self.tracks.update(dt)
+        if self.track_renderer is not None:
+            self.track_renderer.update(dt)
+            self.track_hit_renderer.update(dt)
 
     def draw(self):
         ''' Called for every frame '''
+        if self.track_renderer is not None:
+            glRotatef(self.rotation, 0, 0, 1)  # rotate telescope
+            for m in self.modules:
+                m.draw(heatmap=self.show_heatmap)
+            self.track_renderer.draw()
+            self.track_hit_renderer.draw()
+            glRotatef(-self.rotation, 0, 0, 1)
+            return
+        if self.tracks.changed:
+            p1, p2 = self.tracks.positions[:, 0], self.tracks.positions[:, 1]
+            direction = p1 - p2
+            self.track_buffer.set_vertices(np.stack((p1 - 1000 * direction, p1 + 1000 * direction), axis=1),
+                                           visible=self.tracks.alive)
+            # Show track hits too
+            track_hits = self.tracks.positions.reshape(-1, 3)
+            self.track_hit_buffer.set_vertices(quad_vertices(track_hits[:, 0], track_hits[:, 1], track_hits[:, 2] + 3.,
+                                                             _HIT_SIZE, _HIT_SIZE), visible=np.repeat(self.tracks.alive, 2))
+            self.track_hit_buffer.set_alpha(np.full(2 * _MAX_TRACKS, 255))
+            self.tracks.changed = False
+        self.track_buffer.set_alpha(self.tracks.alpha())
         glRotatef(self.rotation, 0, 0, 1)  # rotate telescope
         for m in self.modules:
-            m.draw()
-        for track in self.tracks:
-            track.draw()
+            m.draw(heatmap=self.show_heatmap)
+        self.batch.draw()
         glRotatef(-self.rotation, 0, 0, 1)
         
     def reset(self):
-        self.tracks = []
+        self.tracks.clear()
+        self.angle_counts[:] = 0
+        if self.track_renderer is not None:
+            self.track_renderer.clear()
+            self.track_hit_renderer.clear()
         for m in self.modules:
-            m.hits = []
+            m.reset()
             
     def add_mc_track(self):
         for m in self.modules:
             m.add_hits([(random.randint(1, 80), random.randint(1, 336))])
-        hit_1 = (self.modules[0].hits[-1].x, self.modules[0].hits[-1].y, self.modules[0].detector.z)
-        hit_2 = (self.modules[1].hits[-1].x, self.modules[1].hits[-1].y, self.modules[1].detector.z)
-        self.tracks.append(Track(hit_1, hit_2))
+        try:
+            self._add_tracks([(self.module_last_hit(0), self.module_last_hit(-1))])
+        except IndexError:  # no hits in a module
+            pass
 
 class Camera(object):
     ''' 3d camera movements '''
@@ -272,10 +587,263 @@ class Camera(object):
             self.reset()
 
 
+class Stats(object):
+    ''' Performance statistics of the application
+
+        Stage times of the declared stages are summed with add_time and
+        averaged per frame over _STATS_INTERVAL seconds together with the
+        rates of the IO and coincidence buffer counters. Hit rates are
+        counted before (raw) and after the noise mask.
+        The latest values are in values, a flat dict with one entry per
+        module for the module counters. They are appended to log_file if
+        given, as csv or with a .json ending as one json object per line.
+        All rows have the same keys, thus the csv columns are fixed by the
+        first row.
+    '''
+
+    def __init__(self, log_file=None, stages=_STATS_STAGES):
+        self.stages = list(stages)
+        self.times = collections.OrderedDict((stage, 0.) for stage in self.stages)
+        self.n_frames = 0
+        self.interval = 0.
+        self.io_stats = None  # IO counters at the last update
+        self.n_coincidences = 0  # coincidence buffer counter at the last update
+        self.values = {}
+        self.log_file = log_file
+        self._out_file = open(log_file, 'w') if log_file is not None else None
+        self._writer = None
+
+    def add_time(self, stage, seconds):
+        ''' Add the time of a stage, raises KeyError for stages that were not declared '''
+        self.times[stage] += seconds
+
+    def update(self, dt, io=None, coincidences=None):
+        ''' Called every frame, returns True if new values are available '''
+        self.n_frames += 1
+        self.interval += dt
+        if self.interval < _STATS_INTERVAL:
+            return False
+        values = collections.OrderedDict([('time', time.time()), ('fps', self.n_frames / self.interval)])
+        for stage in self.stages:
+            values['%s_ms' % stage] = 1e3 * self.times[stage] / self.n_frames
+        if io is not None:
+            io_stats = io.stats()
+            last = self.io_stats if self.io_stats is not None else dict((k, [0] * len(v)) for k, v in io_stats.items())
+            for i in range(len(io_stats['received'])):
+                values['receive_ms_%d' % i] = 1e3 * (io_stats['receive_time'][i] - last['receive_time'][i]) / self.n_frames
+                values['decode_ms_%d' % i] = 1e3 * (io_stats['decode_time'][i] - last['decode_time'][i]) / self.n_frames
+                values['readouts_per_s_%d' % i] = (io_stats['received'][i] - last['received'][i]) / self.interval
+                values['raw_hits_per_s_%d' % i] = (io_stats['raw_hits'][i] - last['raw_hits'][i]) / self.interval
+                values['hits_per_s_%d' % i] = (io_stats['hits'][i] - last['hits'][i]) / self.interval
+                values['queued_%d' % i] = io_stats['queued'][i]
+                values['skipped_%d' % i] = io_stats['skipped'][i]
+                values['dropped_%d' % i] = io_stats['dropped'][i]
+                values['masked_%d' % i] = io_stats['masked'][i]
+            self.io_stats = io_stats
+        if coincidences is not None:
+            values['coincidences_per_s'] = (coincidences.n_coincidences - self.n_coincidences) / self.interval
+            values['buffered_readouts'] = len(coincidences)
+            values['late_readouts'] = coincidences.n_late
+            values['invalid_readouts'] = coincidences.n_invalid
+            values['restarts'] = coincidences.n_restarts
+            self.n_coincidences = coincidences.n_coincidences
+        self.values = values
+        self.log(values)
+        for stage in self.stages:
+            self.times[stage] = 0.
+        self.n_frames = 0
+        self.interval = 0.
+        return True
+
+    def log(self, values):
+        if self._out_file is None:
+            return
+        if self.log_file.endswith('.json'):
+            self._out_file.write(json.dumps(values) + '\n')
+        else:
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._out_file, fieldnames=list(values))
+                self._writer.writeheader()
+            self._writer.writerow(values)
+        self._out_file.flush()
+
+    def text(self):
+        ''' Multi line summary of the values for the overlay '''
+        values = self.values
+        if not values:
+            return ''
+        stages = ', '.join('%s %.2f' % (stage, values['%s_ms' % stage]) for stage in self.stages)
+        lines = ['%.0f fps, frame time [ms]: %s' % (values['fps'], stages)]
+        i = 0
+        while 'receive_ms_%d' % i in values:
+            lines.append('module %d: receive %.2f ms, decode %.2f ms, %.0f readouts/s, %.0f hits/s (%.0f before mask), %d queued, %d skipped, %d dropped, %d masked' %
+                         (i, values['receive_ms_%d' % i], values['decode_ms_%d' % i], values['readouts_per_s_%d' % i],
+                          values['hits_per_s_%d' % i], values['raw_hits_per_s_%d' % i], values['queued_%d' % i], values['skipped_%d' % i],
+                          values['dropped_%d' % i], values['masked_%d' % i]))
+            i += 1
+        if 'coincidences_per_s' in values:
+            lines.append('coincidences: %.0f /s, %d readouts buffered, %d late, %d without timestamp, %d restarts' %
+                         (values['coincidences_per_s'], values['buffered_readouts'], values['late_readouts'],
+                          values['invalid_readouts'], values['restarts']))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._out_file is not None:
+            self._out_file.close()
+            self._out_file = None
+
+
+class Pipeline(object):
+    ''' Data processing of the application, needs no window
+
+        The readouts are fetched from io (pybario.IO) or, for a replay, from
+        player (recording.Player) and are recorded if the telescope has a
+        recorder. The readouts of _COMBINE_TIME seconds are combined,
+        measured with the wall clock or with the readout timestamps, and
+        shown by the telescope. The time per frame of the stages is added
+        to stats (see Stats).
+    '''
+
+    def __init__(self, telescope, io=None, player=None, stats=None):
+        self.telescope = telescope
+        self.io = io
+        self.player = player
+        self.stats = stats if stats is not None else Stats()
+        n_modules = len(telescope.modules)
+        self.coincidences = None
+        if _TIME_COINCIDENCE:
+            self.coincidences = pybario.CoincidenceBuffer(n_modules, reorder_window=_REORDER_WINDOW)
+        self.mh = [[] for _ in range(n_modules)]  # hit arrays per module of the combined readouts
+        self.mc = [[] for _ in range(n_modules)]  # cluster arrays per module of the combined readouts without coincidences
+        self.combine_time = 0.  # wall clock time of the combined readouts
+        self.readout_time = None  # first and last readout timestamp of the combined readouts
+
+    def process(self, dt, pause=False):
+        ''' Fetch and combine data, called in fixed intervals independent of the frame rate
+
+            The readouts of a recording are due with their recorded timing
+            and are processed like received ones, the replay stops during
+            pause.
+        '''
+        if self.player is not None:
+            if pause:
+                return
+            module_readouts = self.player.advance(dt)
+            mh, timestamps = readout_batches(module_readouts)
+            module_hit_counts = readout_hit_counts(module_readouts)
+        elif self.io is not None:
+            mh, timestamps = self.io.get_module_batches()
+            module_readouts = self.io.get_module_readouts()
+            module_hit_counts = self.io.get_module_hit_counts()
+        else:
+            return
+        t_start = time.time()
+        self.process_batches(dt, mh, timestamps, module_readouts, module_hit_counts, pause=pause)
+        self.stats.add_time('aggregation', time.time() - t_start)
+
+    def process_batches(self, dt, mh, timestamps, module_readouts, module_hit_counts, pause=False):
+        ''' Combine the fetched readouts and show them every _COMBINE_TIME
+
+            mh and timestamps are the shown hits (see
+            pybario.IO.get_module_batches), module_readouts the decoded
+            readouts with all hits and clusters that are recorded and
+            module_hit_counts the hits per pixel of all hits for the
+            heatmaps (see pybario.IO.get_module_hit_counts). The tracks
+            are found in the clusters of the coincidences that became final
+            (see pybario.CoincidenceBuffer) or without _TIME_COINCIDENCE in all
+            clusters of the combined readouts. During pause the readouts
+            are only recorded.
+        '''
+        if self.telescope.recorder is not None:
+            self.telescope.recorder.record_readouts(module_readouts)
+        if pause:  # discard data while paused
+            return
+        for m, counts in zip(self.telescope.modules, module_hit_counts):
+            m.add_hit_counts(counts)
+        for i, readouts in enumerate(module_readouts):
+            for readout in readouts:
+                if self.coincidences is not None:
+                    self.coincidences.push(i, readout.timestamp, readout.clusters)
+                else:
+                    self.mc[i].append(readout.clusters)
+        for i, hits in enumerate(mh):
+            if hits is not None and hits.shape[0]:
+                self.mh[i].append(hits)
+        for t in timestamps:
+            if t is not None and t.shape[0]:
+                if self.readout_time is None:
+                    self.readout_time = [t[:, 0].min(), t[:, 1].max()]
+                else:
+                    self.readout_time = [min(self.readout_time[0], t[:, 0].min()), max(self.readout_time[1], t[:, 1].max())]
+        self.combine_time += dt
+        if _COMBINE_READOUT_TIME:
+            combine_time = 0. if self.readout_time is None else self.readout_time[1] - self.readout_time[0]
+        else:
+            combine_time = self.combine_time
+        if combine_time >= _COMBINE_TIME:
+            if self.coincidences is not None:
+                module_clusters = self.coincidences.pop()
+            else:
+                module_clusters = [np.concatenate(clusters) if clusters else None for clusters in self.mc]
+                self.mc = [[] for _ in self.mc]
+            self.telescope.add_module_hits([np.concatenate(hits) if hits else None for hits in self.mh],
+                                           module_clusters, readout_time=self.readout_time)
+            self.mh = [[] for _ in self.mh]
+            self.combine_time = 0.
+            self.readout_time = None
+
+    def update(self, dt, pause=False):
+        ''' Fade hits and tracks with the clock time dt and update the statistics
+
+            Returns True if new statistics are available (see Stats.update).
+        '''
+        if not pause:
+            t_start = time.time()
+            self.telescope.update(dt)
+            self.stats.add_time('update', time.time() - t_start)
+        return self.stats.update(dt, self.io, self.coincidences)
+
+    def close(self):
+        ''' Stop the data receiving, this stores the noise masks for the next run, and close all files '''
+        if self.io is not None:
+            self.io.close()
+        if self.telescope.recorder is not None:
+            self.telescope.recorder.close()
+            self.telescope.recorder = None
+        if self.player is not None:
+            self.player.close()
+        self.stats.close()
+
+
+def setup_gl():
+    ''' 3d settings of the current OpenGL context '''
+    glClearColor(*_CLEAR_COLOR)
+    glEnable(GL_DEPTH_TEST)
+    glEnable(GL_LINE_SMOOTH)
+    glHint(GL_LINE_SMOOTH_HINT, GL_DONT_CARE)
+    glLineWidth(5)
+    glEnable(GL_BLEND)  # transparency
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)  # transparency
+    glEnable(GL_CULL_FACE)
+
+
 class App(pyglet.window.Window):
-    ''' 3d application window'''
+    ''' 3d application window
+
+        The telescope modules are read from the geometry_file keyword
+        argument (see load_geometry). With the record_file keyword argument
+        all decoded readouts and the found tracks are recorded (see
+        recording), with replay_file the readouts of a recording are shown
+        instead of the pyBAR data. The data is processed by a Pipeline.
+        Performance statistics are logged to the stats_file keyword argument
+        (see Stats).
+    '''
 
     def __init__(self, *args, **kwargs):
+        geometry = load_geometry(kwargs.pop('geometry_file', _GEOMETRY_FILE))
+        record_file = kwargs.pop('record_file', None)
+        replay_file = kwargs.pop('replay_file', None)
+        self.stats = Stats(log_file=kwargs.pop('stats_file', None))
         if sys.version_info[0] < 3:
             super(App, self).__init__(*args, **kwargs)
         else:
@@ -284,24 +852,54 @@ class App(pyglet.window.Window):
         self.keys = key.KeyStateHandler()
         self.push_handlers(self.keys)
         pyglet.clock.schedule(self.update)
+        pyglet.clock.schedule_interval(self.process, _PROCESS_INTERVAL)
 
-        self.telescope = Telescope()
+        self.telescope = Telescope(geometry=geometry)
         self.camera = Camera()
-        self.io = pybario.IO(addresses=['tcp://127.0.0.1:5678', 'tcp://127.0.0.1:5679'], max_hits=_MAX_HITS)
+        if record_file is not None or replay_file is not None:
+            import recording  # imports tables, which is slow and only needed here
+        if record_file is not None:
+            self.telescope.recorder = recording.Recorder(record_file, n_planes=len(geometry))
+        io, player = None, None
+        if replay_file is not None:
+            player = recording.Player(replay_file)
+        else:
+            io_kwargs = dict(max_hits=_MAX_HITS, clustering=_CLUSTER_HITS, processes=_DECODER_PROCESSES,
+                             noise_masks=[m['noise_mask'] for m in geometry], policy=_READOUT_POLICY,
+                             sample_every=_SAMPLE_EVERY, rcvhwm=_RCVHWM)
+            if _ASYNC_IO:
+                import pybario_asyncio  # Python 3 only
+                io = pybario_asyncio.AsyncIO(addresses=[m['address'] for m in geometry], own_thread=_THREADED_IO,
+                                             **io_kwargs)
+                if not _THREADED_IO:
+                    pyglet.clock.schedule(io.step)
+            else:
+                io = pybario.IO(addresses=[m['address'] for m in geometry], threaded=_THREADED_IO, **io_kwargs)
+        self.pipeline = Pipeline(self.telescope, io=io, player=player, stats=self.stats)
 
         # Interface
         self.fps = pyglet.window.FPSDisplay(window=self)
         self.fps.label.font_size = 12
+        self.stats_label = pyglet.text.Label('', font_name="Arial", font_size=12, x=10, y=self.height - 10, width=self.width,
+                                             multiline=True, anchor_x='left', anchor_y='top', color=(0, 0, 0, 255))
         # Legend
         self.text = pyglet.text.Label("Pixeltreffer", font_name="Arial", font_size=40, width=0.1 * self.width, x=self.width + 50, y=0.85*self.height,
                                       anchor_x='left', anchor_y='center', color=(255, 0, 0, 220))
+        self.angle_label = pyglet.text.Label("Spurwinkel 0 - %d Grad" % round(math.degrees(self.telescope.track_finder.max_angle)),
+                                             font_name="Arial", font_size=12, anchor_x='left', anchor_y='bottom',
+                                             color=(0, 128, 187, 255))
+        self.angle_batch = pyglet.graphics.Batch()
+        self.angle_histogram = VertexBuffer(_ANGLE_BINS, 4, GL_QUADS, (0, 128, 187), self.angle_batch)
+        self.angle_histogram.set_alpha(np.full(_ANGLE_BINS, 220))
         self.text_2 = pyglet.text.Label("Teilchenspuren", font_name="Arial", font_size=40, width=0.1 * self.width, x=self.width + 50, y=0.85*self.height - 100,
                                         anchor_x='left', anchor_y='center', color=(0, 128, 187, 220))
 
-        self.logo = pyglet.sprite.Sprite(pyglet.image.load(os.path.join(script_dir, 'media', 'Silab.png')), x=self.width * 0.98, y=self.height * 0.98, subpixel=True)
+        self.logo = pyglet.sprite.Sprite(media_image('Silab.png'), x=self.width * 0.98, y=self.height * 0.98, subpixel=True)
         self.logo.scale = 0.2
 
-        self.sound_logo = pyglet.sprite.Sprite(pyglet.image.load(os.path.join(script_dir, 'media', 'sound_off.png')), x=self.width * 0.98, y=self.height * 0.02, subpixel=True)
+        # Sound symbols of the sound options off, tracks only and hits and tracks
+        self.sound_images = [media_image(name) for name in ('sound_off.png', 'sound_silent.png', 'sound.png')]
+        self.sound_logo = pyglet.sprite.Sprite(self.sound_images[0], x=self.width * 0.98, y=self.height * 0.02, subpixel=True)
         self.sound_logo.scale = 0.2
         #self.sound_logo.x -= self.sound_logo.width
         #self.sound_logo.y += self.sound_logo.height
@@ -313,10 +911,13 @@ class App(pyglet.window.Window):
         self.sound_logo.y = self.sound_logo.height
         # Options
         self.show_logo = True
+        self.show_stats = False
         self.pause = False
-        
-        self.n_ro = 0
-        self.mh =  [None, None]
+
+    def close(self):
+        ''' Stop the data processing (see Pipeline.close) '''
+        self.pipeline.close()
+        pyglet.window.Window.close(self)
 
     def push(self, pos, rot):
         glPushMatrix()
@@ -371,10 +972,12 @@ class App(pyglet.window.Window):
             self.telescope.play_sounds += 1
             if self.telescope.play_sounds > 2:
                 self.telescope.play_sounds = 0
-            if self.telescope.play_sounds:
-                self.sound_logo.image = pyglet.image.load(os.path.join(script_dir, 'media', 'sound.png') if self.telescope.play_sounds > 1 else os.path.join(script_dir, 'media', 'sound_silent.png'))
-            else:
-                self.sound_logo.image = pyglet.image.load(os.path.join(script_dir, 'media', 'sound_off.png'))
+            self.sound_logo.image = self.sound_images[self.telescope.play_sounds]
+        elif KEY == key.I:
+            self.show_stats = not self.show_stats
+            self.stats_label.text = self.stats.text()
+        elif KEY == key.H:
+            self.telescope.show_heatmap = not self.telescope.show_heatmap
         elif KEY == key.P:
             self.pause = not self.pause
         elif KEY == key.R:
@@ -382,27 +985,28 @@ class App(pyglet.window.Window):
         elif KEY == key.SPACE:
             self.telescope.add_mc_track()
 
+    def process(self, dt):
+        ''' Fetch and combine data, called in fixed intervals independent of the frame rate '''
+        self.pipeline.process(dt, pause=self.pause)
+
     def update(self, dt):
-        self.n_ro = self.n_ro + 1
-        mh = self.io.get_module_hits()
-        
+        ''' Called every frame, hits and tracks fade with the clock time dt '''
         if not self.pause:
-            if mh[0]:
-                if self.mh[0] is None:
-                    self.mh[0] = mh[0]
-                else:
-                    self.mh[0].extend(mh[0])
-            if mh[1]:
-                if self.mh[1] is None:
-                    self.mh[1] = mh[1]
-                else:
-                    self.mh[1].extend(mh[1])
-            if self.n_ro >= _COMBINE_N_READOUTS:
-                self.n_ro = 0
-                self.telescope.add_module_hits(self.mh)
-                self.mh = [None, None]
             self.camera.update(dt, self.keys)
-            self.telescope.update(dt)
+        if self.pipeline.update(dt, pause=self.pause) and self.show_stats:
+            self.stats_label.text = self.stats.text()
+
+    def draw_angle_histogram(self):
+        ''' Bars of the track angle counts in the lower left corner '''
+        x, y, width, height = 0.02 * self.width, 0.05 * self.height, 0.25 * self.width, 0.2 * self.height
+        counts = self.telescope.angle_counts
+        bar_width = width / counts.shape[0]
+        self.angle_histogram.set_vertices(quad_vertices(x + bar_width * np.arange(counts.shape[0]), np.full(counts.shape[0], y),
+                                                        np.zeros(counts.shape[0]), 0.9 * bar_width,
+                                                        height * counts / max(counts.max(), 1)))
+        self.angle_batch.draw()
+        self.angle_label.x, self.angle_label.y = x, y + height + 5
+        self.angle_label.draw()
 
     def draw_legend(self):
         glMatrixMode(gl.GL_MODELVIEW)
@@ -416,11 +1020,17 @@ class App(pyglet.window.Window):
         self.text.draw()
         self.text_2.draw()
         self.sound_logo.draw()
+        if self.telescope.show_heatmap:
+            self.draw_angle_histogram()
+        if self.show_stats:
+            self.stats_label.y = self.height - 10
+            self.stats_label.draw()
         glPopMatrix()
         glMatrixMode(GL_MODELVIEW)
         glPopMatrix()
 
     def on_draw(self):
+        t_start = time.time()
         self.clear()
         self.set3d()
         self.draw_legend()
@@ -428,18 +1038,18 @@ class App(pyglet.window.Window):
         self.push(self.camera.pos, self.camera.rot)
         self.telescope.draw()
         glPopMatrix()
+        self.stats.add_time('draw', time.time() - t_start)
 
 
 if __name__ == '__main__':
-    window = App(caption='Pixel detector model', resizable=True, fullscreen=True)
-    # 3d settings
-    glClearColor(*_CLEAR_COLOR)
-    glEnable(GL_DEPTH_TEST)
-    glEnable(GL_LINE_SMOOTH)
-    glHint(GL_LINE_SMOOTH_HINT, GL_DONT_CARE)
-    glLineWidth(5)
-    glEnable(GL_BLEND)  # transparency
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)  # transparency
-    glEnable(GL_CULL_FACE)
+    parser = argparse.ArgumentParser(description='Pixel detector model')
+    parser.add_argument('geometry_file', nargs='?', default=_GEOMETRY_FILE, help='telescope geometry (json)')
+    parser.add_argument('--record', help='record all decoded readouts and the found tracks to this file (h5)')
+    parser.add_argument('--replay', help='show a recording instead of the pyBAR data')
+    parser.add_argument('--stats', help='log performance statistics to this file (csv or json)')
+    args = parser.parse_args()
+    window = App(caption='Pixel detector model', resizable=True, fullscreen=True, geometry_file=args.geometry_file,
+                 record_file=args.record, replay_file=args.replay, stats_file=args.stats)
+    setup_gl()
 
     pyglet.app.run()
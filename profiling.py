@@ -0,0 +1,136 @@
+''' Reproducible profiling of the visualization without live data
+
+    A recording (see main.py --record) is replayed with a fixed frame time
+    for a number of frames as fast as possible. Random numbers are seeded,
+    e.g. for Monte Carlo tracks added every frame. The frames are processed
+    by the data pipeline of the application (main.Pipeline) with a headless
+    telescope or drawn by the application into an offscreen buffer (needs
+    EGL). The cProfile statistics and the time per frame of
+    every stage are reported, e.g.:
+
+        python profiling.py --replay run.h5 --frames 2000 --draw --pstats profile.pstats
+'''
+
+import argparse
+import collections
+import cProfile
+import json
+import pstats
+import random
+import time
+
+import numpy as np
+
+import benchmark
+
+
+def _timed(times, stage, function, *args):
+    t_start = time.perf_counter()
+    function(*args)
+    times[stage].append(time.perf_counter() - t_start)
+
+
+def run(replay_file=None, n_frames=1000, dt=1 / 60., seed=0, mc_tracks=0, draw=False, size=(1280, 720),
+        geometry_file=None, profile=None):
+    ''' Run n_frames frames and return the per frame times in s of every stage
+
+        Without draw the data pipeline of the application runs with a
+        headless telescope (process: combine the due readouts of the
+        recording and find tracks, update: fading and statistics), with
+        draw the application processes, updates and draws every frame
+        (draw waits for the GPU). mc_tracks Monte Carlo tracks are added
+        every frame. A cProfile.Profile given as profile is enabled during
+        the frames.
+    '''
+    import pyglet
+    pyglet.options['shadow_window'] = False
+    if draw:
+        pyglet.options['headless'] = True  # offscreen OpenGL context with EGL
+    import main
+    import recording
+
+    random.seed(seed)
+    np.random.seed(seed)
+    geometry = main.load_geometry(geometry_file if geometry_file is not None else main._GEOMETRY_FILE)
+    times = collections.OrderedDict()
+    if draw:
+        if replay_file is None:
+            raise ValueError('Drawing the application needs a recording')
+        app = main.App(width=size[0], height=size[1], visible=False, geometry_file=geometry_file or main._GEOMETRY_FILE,
+                       replay_file=replay_file)
+        main.setup_gl()
+        telescope = app.telescope
+
+        def draw_frame():
+            app.on_draw()
+            main.glFinish()
+        process, update = app.process, app.update
+    else:
+        telescope = main.Telescope(geometry=geometry, headless=True)
+        pipeline = main.Pipeline(telescope, player=recording.Player(replay_file) if replay_file is not None else None)
+        process, update = pipeline.process, pipeline.update
+
+    def add_mc_tracks():
+        for _ in range(mc_tracks):
+            telescope.add_mc_track()
+    stages = [('process', process, dt), ('mc_tracks', add_mc_tracks), ('update', update, dt)]
+    if draw:
+        stages.append(('draw', draw_frame))
+    for stage in stages:
+        times[stage[0]] = []
+    if profile is not None:
+        profile.enable()
+    for _ in range(n_frames):
+        for stage in stages:
+            _timed(times, *stage)
+    if profile is not None:
+        profile.disable()
+    if draw:
+        app.close()
+    else:
+        pipeline.close()
+    return collections.OrderedDict((stage, np.array(t)) for stage, t in times.items())
+
+
+def summary(times):
+    ''' Total time and percentiles of the time per frame of every stage and of the whole frame '''
+    times = collections.OrderedDict(times)
+    times['frame'] = np.sum(list(times.values()), axis=0)
+    results = collections.OrderedDict()
+    for stage, t in times.items():
+        results[stage] = benchmark.percentiles(t)
+        results[stage]['total_s'] = t.sum()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile the visualization with a recording and a fixed frame time')
+    parser.add_argument('--replay', help='recording to replay (h5, see main.py --record)')
+    parser.add_argument('--geometry', help='telescope geometry (json), default is geometry.json')
+    parser.add_argument('--frames', type=int, default=1000, help='number of frames')
+    parser.add_argument('--dt', type=float, default=1 / 60., help='frame time in s')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--mc-tracks', type=int, default=0, help='Monte Carlo tracks added per frame')
+    parser.add_argument('--draw', action='store_true', help='draw the application offscreen (needs EGL)')
+    parser.add_argument('--pstats', help='write the cProfile statistics to this file')
+    parser.add_argument('--top', type=int, default=25, help='number of functions shown, sorted by cumulative time')
+    parser.add_argument('--json', help='write the stage timing summary to this json file')
+    args = parser.parse_args()
+
+    profile = cProfile.Profile()
+    times = run(replay_file=args.replay, n_frames=args.frames, dt=args.dt, seed=args.seed, mc_tracks=args.mc_tracks,
+                draw=args.draw, geometry_file=args.geometry, profile=profile)
+    statistics = pstats.Stats(profile)
+    if args.pstats:
+        statistics.dump_stats(args.pstats)
+    statistics.sort_stats('cumulative').print_stats(args.top)
+
+    results = summary(times)
+    print('Time per frame of %d frames' % args.frames)
+    print('%-12s %10s %10s %10s %10s' % ('stage', 'total [s]', 'p50 [us]', 'p90 [us]', 'p99 [us]'))
+    for stage, result in results.items():
+        print('%-12s %10.3f %10.1f %10.1f %10.1f' % (stage, result['total_s'], result['p50_us'], result['p90_us'],
+                                                     result['p99_us']))
+    if args.json:
+        with open(args.json, 'w') as out_file:
+            json.dump(dict(config=vars(args), results=results), out_file, indent=2)
@@ -1,10 +1,26 @@
 ''' Simple data analysis of FE-I4 raw data
 '''
 
+import collections
+import multiprocessing
+import os
+import threading
+import time
+
 import zmq
 import numpy as np
 
 _MAX_NOISE_HITS = 10
+_N_COLS, _N_ROWS = 80, 336  # FE-I4 pixel matrix
+_PIXEL_PITCH = (0.25, 0.05)  # col, row pitch in mm
+_SENSOR_CENTER = ((_N_COLS + 1) / 2., (_N_ROWS + 1) / 2.)  # col, row
+_NOISE_DECAY = 1e-3  # weight loss of the occupancy per readout
+_NOISE_THRESHOLD = 0.2  # hits per readout above which a pixel is masked
+_NOISE_MIN_READOUTS = 100  # readouts needed before pixels are masked
+_POLICIES = ('all', 'latest', 'sample')  # readout policies of IO
+_RECEIVE_BURST = 10  # readouts received per module and round of the receiver, so no module starves the others
+_MAX_TRACK_ANGLE = 0.3  # polar angle cut of tracks in rad, about 17 degree
+_COINCIDENCE_KEY_STRIDE = float(1 << 32)  # event key offset between coincidences, above all event keys
 
 # Copied from pybar.daq.readout_utils
 def is_data_record(value):
@@ -12,54 +28,985 @@ def is_data_record(value):
                                          np.less_equal(np.bitwise_and(value, 0x0001FF00), 0x00015000)),
                                          np.logical_and(np.not_equal(np.bitwise_and(value, 0x00FE0000), 0x00000000),
                                                         np.not_equal(np.bitwise_and(value, 0x0001FF00), 0x00000000)))
-    
+
+
+# Copied from pybar.daq.readout_utils
+def is_trigger_word(value):
+    return np.equal(np.bitwise_and(value, 0x80000000), 0x80000000)
+
+
+# Copied from pybar.daq.readout_utils
+def is_data_header(value):
+    return np.equal(np.bitwise_and(value, 0x00FF0000), 0b111010010000000000000000)
+
+
+def get_trigger_number(value):
+    return np.bitwise_and(value, 0x7FFFFFFF)
+
+
+def get_bcid(value):
+    return np.bitwise_and(value, 0x000003FF)  # FE-I4B
+
+
+def get_lvl1id(value):
+    return np.bitwise_and(np.right_shift(value, 10), 0x0000001F)  # FE-I4B
+
+
+def pixel_keys(hits):
+    ''' Packed pixel index col * 336 + row (zero based) of (N, 2) col/row hit array '''
+    return (hits[:, 0] - 1) * _N_ROWS + (hits[:, 1] - 1)
+
+
+def hit_counts(hits):
+    ''' Hits per pixel, indexed by the pixel keys (see pixel_keys), of (N, 2) col/row hit array '''
+    return np.bincount(pixel_keys(hits), minlength=_N_COLS * _N_ROWS)
+
+
+def noise_mask_from_hits(noise_hits, mask=None):
+    ''' Boolean pixel bitmap (80 * 336) that is True for the given hits
+
+        An existing mask can be given to be reused (it is cleared first)
+    '''
+    if mask is None:
+        mask = np.zeros(_N_COLS * _N_ROWS, dtype=bool)
+    else:
+        mask[:] = False
+    noise_hits = np.asarray(noise_hits, dtype=np.int64).reshape(-1, 2)
+    mask[pixel_keys(noise_hits)] = True
+    return mask
+
+
+def _col_row_selection(words):
+    ''' Column and row fields of all words and the data record selection '''
+    # Column and row fields are extracted once and reused for the data record
+    # selection, this is equivalent to is_data_record. In place operations
+    # avoid temporary copies of the raw data.
+    cols = np.bitwise_and(words, 0x00FE0000)
+    np.right_shift(cols, 17, out=cols)
+    rows = np.bitwise_and(words, 0x0001FF00)
+    np.right_shift(rows, 8, out=rows)
+    selection = cols != 0
+    selection &= cols <= _N_COLS
+    selection &= rows != 0
+    selection &= rows <= _N_ROWS
+    return cols, rows, selection
+
+
+def col_row_array(words, max_hits=None, noise_mask=None):
+    ''' Decode raw words into an (N, 2) array of col, row hits
+
+        Hits of pixels set in the boolean noise_mask (80 * 336 bitmap indexed
+        by pixel_keys) are removed. At most max_hits hits are returned.
+    '''
+    cols, rows, selection = _col_row_selection(words)
+    hits = np.empty(shape=(np.count_nonzero(selection), 2), dtype=np.int32)
+    hits[:, 0] = cols[selection]
+    hits[:, 1] = rows[selection]
+    if noise_mask is not None:
+        hits = hits[~noise_mask.reshape(-1)[pixel_keys(hits)]]
+    return hits[:max_hits]
+
+
 # Based on pybar.daq.readout_utils.get_col_row_iterator_from_data_records
 def col_row_pairs(words, max_hits, noise_hits):
-    data_records = words[:][is_data_record(words[:])]
-    cols, rows = np.right_shift(np.bitwise_and(data_records, 0x00FE0000), 17), np.right_shift(np.bitwise_and(data_records, 0x0001FF00), 8)
-    hits = zip(cols, rows)
-    hits = [hit for hit in hits if hit not in noise_hits]
-    return hits[:max_hits]
+    ''' List of (col, row) tuples, list interface of col_row_array '''
+    hits = col_row_array(words, max_hits=max_hits, noise_mask=noise_mask_from_hits(noise_hits))
+    return [tuple(hit) for hit in hits.tolist()]
+
+
+def event_hit_array(words, noise_mask=None):
+    ''' Decode raw words into an (N, 3) array of event, col, row hits
+
+        A new event starts with every trigger word. Without trigger words
+        (e.g. self trigger) a new event starts when the LVL1ID of the data
+        headers changes. Words before the first event start belong to
+        event 0. Returns the hits and per event the trigger number (-1 if
+        unknown) and the BCID of the first data header (-1 if none).
+    '''
+    trigger_words = is_trigger_word(words)
+    headers = np.flatnonzero(is_data_header(words) & ~trigger_words)
+    if trigger_words.any():
+        new_event = trigger_words
+    else:
+        lvl1ids = get_lvl1id(words[headers])
+        new_event = np.zeros(shape=words.shape[0], dtype=bool)
+        new_event[headers[1:]] = lvl1ids[1:] != lvl1ids[:-1]
+    events = np.cumsum(new_event)
+    n_events = events[-1] + 1 if words.shape[0] else 1
+
+    triggers = np.full(shape=n_events, fill_value=-1, dtype=np.int64)
+    if trigger_words.any():
+        triggers[1:] = get_trigger_number(words[trigger_words])
+    bcids = np.full(shape=n_events, fill_value=-1, dtype=np.int64)
+    header_events, first_headers = np.unique(events[headers], return_index=True)
+    bcids[header_events] = get_bcid(words[headers[first_headers]])
+
+    cols, rows, selection = _col_row_selection(words)
+    selection &= ~trigger_words
+    hits = np.empty(shape=(np.count_nonzero(selection), 3), dtype=np.int32)
+    hits[:, 0] = events[selection]
+    hits[:, 1] = cols[selection]
+    hits[:, 2] = rows[selection]
+    if noise_mask is not None:
+        hits = hits[~noise_mask.reshape(-1)[pixel_keys(hits[:, 1:])]]
+    return hits, triggers, bcids
+
+
+def event_keys(triggers, bcids):
+    ''' Keys to combine the events of different modules (see TrackFinder)
+
+        The trigger number if it is known, otherwise (e.g. self trigger)
+        -2 - BCID since the bunch crossing counters of all modules run with
+        the same clock while the LVL1IDs are counted per module. -1 if
+        neither is known.
+    '''
+    keys = np.where(bcids >= 0, -2 - bcids, -1)
+    return np.where(triggers >= 0, triggers, keys)
+
+
+def cluster_hits(hits):
+    ''' Group adjacent pixels (also diagonal) of the same event into clusters
+
+        hits is an (N, 3) array of event, col, row. Returns a (K, 3) float
+        array of cluster event, centroid col and centroid row and the
+        number of pixels per cluster. Connected components are found by
+        iterative minimum label propagation on the pixel neighbour pairs.
+    '''
+    # Padded strides, neighbours of border pixels do not alias other pixels
+    col_stride, event_stride = _N_ROWS + 2, (_N_COLS + 2) * (_N_ROWS + 2)
+    keys = np.unique(hits[:, 0].astype(np.int64) * event_stride + hits[:, 1] * col_stride + hits[:, 2])
+    n_pixels = keys.shape[0]
+    if not n_pixels:
+        return np.empty(shape=(0, 3), dtype=np.float64), np.empty(shape=0, dtype=np.int64)
+
+    # Pairs of neighbouring pixels
+    first, second = [], []
+    for d_col, d_row in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        neighbours = keys + d_col * col_stride + d_row
+        index = np.minimum(np.searchsorted(keys, neighbours), n_pixels - 1)
+        found = keys[index] == neighbours
+        first.append(np.flatnonzero(found))
+        second.append(index[found])
+    first, second = np.concatenate(first), np.concatenate(second)
+
+    labels = np.arange(n_pixels)
+    while True:
+        min_labels = np.minimum(labels[first], labels[second])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, first, min_labels)
+        np.minimum.at(new_labels, second, min_labels)
+        new_labels = new_labels[new_labels]  # pointer jumping
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    roots, labels = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(labels)
+    clusters = np.empty(shape=(roots.shape[0], 3), dtype=np.float64)
+    clusters[:, 0] = keys[roots] // event_stride
+    clusters[:, 1] = np.bincount(labels, weights=(keys % event_stride) // col_stride) / sizes
+    clusters[:, 2] = np.bincount(labels, weights=keys % col_stride) / sizes
+    return clusters, sizes
+
+
+class NoiseMask(object):
+    ''' Online hot pixel mask of one module
+
+        Every pixel has an exponentially decayed occupancy (hits per readout,
+        the weight of a readout decays with decay per readout). Pixels above
+        threshold are masked. The occupancy can be saved to and loaded from a
+        npz file, thus the mask of the last run is used from the start and
+        keeps decaying.
+    '''
+    def __init__(self, decay=_NOISE_DECAY, threshold=_NOISE_THRESHOLD, min_readouts=_NOISE_MIN_READOUTS, filename=None):
+        self.decay = decay
+        self.threshold = threshold
+        self.min_readouts = min_readouts
+        self.occupancy = np.zeros(_N_COLS * _N_ROWS, dtype=np.float64)
+        self.n_readouts = 0.  # decayed number of readouts
+        self.mask = np.zeros(_N_COLS * _N_ROWS, dtype=bool)
+        self.n_masked = 0  # hits removed by the mask
+        if filename is not None and os.path.isfile(filename):
+            self.load(filename)
+
+    def fill(self, keys, n_readouts=1):
+        ''' Add the pixel keys (see pixel_keys) of n_readouts readouts and update the mask
+
+            Returns the hits per pixel of the keys.
+        '''
+        counts = np.bincount(keys, minlength=self.occupancy.shape[0])
+        scale = (1. - self.decay) ** n_readouts
+        self.occupancy *= scale
+        self.occupancy += counts
+        self.n_readouts = self.n_readouts * scale + n_readouts
+        self._update_mask()
+        return counts
+
+    def _update_mask(self):
+        if self.n_readouts >= self.min_readouts:
+            np.greater(self.occupancy, self.threshold * self.n_readouts, out=self.mask)
+
+    def apply(self, keys):
+        ''' Selection of the not masked pixel keys '''
+        selection = ~self.mask[keys]
+        self.n_masked += int(keys.shape[0] - np.count_nonzero(selection))
+        return selection
+
+    def reset(self):
+        self.occupancy[:] = 0.
+        self.n_readouts = 0.
+        self.mask[:] = False
+
+    def save(self, filename):
+        with open(filename, 'wb') as out_file:  # keep the file name, np.savez would append .npz
+            np.savez(out_file, occupancy=self.occupancy.reshape(_N_COLS, _N_ROWS), n_readouts=self.n_readouts)
+
+    def load(self, filename):
+        with np.load(filename) as in_file:
+            self.occupancy[:] = in_file['occupancy'].reshape(-1)
+            self.n_readouts = float(in_file['n_readouts'])
+        self._update_mask()
+
+
+def rotation_matrices(rotations):
+    ''' (N, 2, 2) matrices of clockwise rotations in degree '''
+    angles = np.radians(np.asarray(rotations, dtype=np.float64))
+    matrices = np.empty(shape=(angles.shape[0], 2, 2))
+    matrices[:, 0, 0] = np.cos(angles)
+    matrices[:, 0, 1] = np.sin(angles)
+    matrices[:, 1, 0] = -np.sin(angles)
+    matrices[:, 1, 1] = np.cos(angles)
+    return matrices
+
+
+class TrackFinder(object):
+    ''' Straight line track finder for time coincident clusters of all planes
+
+        z are the plane positions in mm, rotations the clockwise plane
+        rotations around the sensor center in degree. Clusters of different
+        planes are combined if their event keys (see event_keys) are equal.
+        All combinations (at most max_combinations) are fitted weighted by
+        the pixel resolution of the rotated planes and tracks with a polar
+        angle below max_angle (rad) and a chi2 / ndf below max_chi2 (only
+        with more than two planes) are accepted.
+    '''
+    def __init__(self, z, rotations=None, max_angle=_MAX_TRACK_ANGLE, max_chi2=10., max_combinations=10000):
+        self.z = np.asarray(z, dtype=np.float64)
+        if rotations is None:
+            rotations = np.zeros_like(self.z)
+        self.rotations = rotation_matrices(rotations)
+        self.max_angle = max_angle
+        self.max_chi2 = max_chi2
+        self.max_combinations = max_combinations
+        self.resolution = np.array(_PIXEL_PITCH) / np.sqrt(12.)
+        # Weighted least squares fit of x, y = offset + slope * dz in the
+        # telescope frame, the weights are the inverse covariances of the
+        # plane resolutions rotated into the telescope frame. The fit
+        # matrix only depends on the geometry and is the same for all
+        # combinations.
+        dz = self.z - self.z.mean()
+        weights = np.einsum('pij,j,pkj->pik', self.rotations, 1. / self.resolution ** 2, self.rotations)
+        self._design = np.zeros(shape=(self.z.shape[0], 2, 4))  # (plane, x/y, offset x/y and slope x/y)
+        self._design[:, :, :2] = np.eye(2)
+        self._design[:, :, 2:] = np.eye(2) * dz[:, np.newaxis, np.newaxis]
+        normal = np.einsum('pji,pjk,pkl->il', self._design, weights, self._design)
+        projection = np.einsum('pji,pjk->ipk', self._design, weights).reshape(4, -1)
+        self._fit = np.linalg.solve(normal, projection).reshape(4, -1, 2)  # parameters of the (plane, x/y) points
+
+    def combinations(self, module_clusters):
+        ''' (C, n_planes) cluster indices of all combinations with equal event key '''
+        combinations = np.arange(module_clusters[0].shape[0])[:, np.newaxis]
+        events = module_clusters[0][:, 0]
+        for clusters in module_clusters[1:]:
+            # Join the combinations with the clusters of this plane on the event key
+            order = np.argsort(clusters[:, 0], kind='mergesort')
+            plane_events = clusters[order, 0]
+            start = np.searchsorted(plane_events, events, side='left')
+            counts = np.searchsorted(plane_events, events, side='right') - start
+            counts[np.cumsum(counts) > self.max_combinations] = 0
+            selection = np.repeat(np.arange(combinations.shape[0]), counts)
+            offsets = np.arange(selection.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+            combinations = np.column_stack((combinations[selection], order[start[selection] + offsets]))
+            events = events[selection]
+        return combinations
+
+    def find_tracks(self, module_clusters):
+        ''' Find tracks in the clusters of all planes
+
+            module_clusters are per plane (K, 3) arrays of event key, col and
+            row (see cluster_hits) or None. Returns the (T, n_planes, 2)
+            col/row cluster positions of the tracks, their chi2 / ndf and
+            polar angles.
+        '''
+        n_planes = self.z.shape[0]
+        if any(c is None or not c.shape[0] for c in module_clusters):
+            return np.empty(shape=(0, n_planes, 2)), np.empty(shape=0), np.empty(shape=0)
+        combinations = self.combinations(module_clusters)
+        col_rows = np.stack([module_clusters[i][combinations[:, i], 1:] for i in range(n_planes)], axis=1)
+
+        # Sensor coordinates relative to the sensor center rotated into the
+        # telescope frame
+        points = (col_rows - _SENSOR_CENTER) * np.array(_PIXEL_PITCH)
+        points = np.einsum('pij,cpj->cpi', self.rotations, points)
+
+        # Straight line fit x(z), y(z) for all combinations at once
+        parameters = np.einsum('ipj,cpj->ci', self._fit, points)
+        slopes = parameters[:, 2:]
+        residuals = points - np.einsum('pji,ci->cpj', self._design, parameters)
+        residuals = np.einsum('pji,cpj->cpi', self.rotations, residuals)  # back to sensor frame
+        ndf = 2 * (n_planes - 2)
+        chi2 = np.sum((residuals / self.resolution) ** 2, axis=(1, 2)) / max(ndf, 1)
+        angles = np.arctan(np.hypot(slopes[:, 0], slopes[:, 1]))
+
+        selection = angles < self.max_angle
+        if ndf:
+            selection &= chi2 < self.max_chi2
+        return col_rows[selection], chi2[selection], angles[selection]
+
+
+class CoincidenceBuffer(object):
+    ''' Time ordered merge of the readouts of several modules for track finding
+
+        Readouts (start/stop timestamps and clusters) are pushed per module.
+        A coincidence is one readout of every module where all time windows
+        (including their ends, readouts can have no duration) overlap, only
+        clusters of the same coincidence are combined to tracks. A time is
+        final if all modules sent readouts up to it or, if a module lags
+        behind, reorder_window seconds before the newest readout of any
+        module. Readouts of a module have to arrive in time order and must
+        not overlap. Readouts that start before the final time are dropped
+        and counted in n_late (their coincidences could be formed already),
+        readouts without timestamps in n_invalid. A readout that starts more
+        than reorder_window before the final time restarts the buffer (e.g.
+        a new run), restarts are counted in n_restarts.
+    '''
+    def __init__(self, n_modules, reorder_window=1.):
+        self.reorder_window = reorder_window
+        self.readouts = [[] for _ in range(n_modules)]  # (start, stop, clusters) per module
+        self.latest = np.full(shape=n_modules, fill_value=-np.inf)  # newest stop timestamp per module
+        self.time = -np.inf  # coincidences starting before are already formed
+        self.n_coincidences = 0
+        self.n_late = 0
+        self.n_invalid = 0
+        self.n_restarts = 0
+
+    def __len__(self):
+        return sum(len(readouts) for readouts in self.readouts)
+
+    def push(self, i, timestamp, clusters):
+        ''' Add a readout of module i with (start, stop) timestamp and (K, 3) clusters '''
+        start, stop = timestamp
+        if not start <= stop:  # also NaN
+            self.n_invalid += 1
+            return
+        if start < self.time - self.reorder_window:  # the timestamps went back, e.g. a restarted run
+            self.restart()
+        elif start < self.time:
+            self.n_late += 1
+            return
+        self.readouts[i].append((start, stop, clusters))
+        self.latest[i] = max(self.latest[i], stop)
+
+    def restart(self):
+        ''' Drop all buffered readouts and start a new timeline '''
+        self.readouts = [[] for _ in self.readouts]
+        self.latest[:] = -np.inf
+        self.time = -np.inf
+        self.n_restarts += 1
+
+    def pop(self, flush=False):
+        ''' Clusters of all coincidences up to the final time
+
+            Returns per module a (K, 3) cluster array or None. The event keys
+            are the coincidence index times _COINCIDENCE_KEY_STRIDE plus the
+            event key, thus TrackFinder combines clusters of the same
+            event and coincidence only. With flush all buffered readouts are
+            final.
+        '''
+        n_modules = len(self.readouts)
+        final = max(self.latest.min(), self.latest.max() - self.reorder_window)
+        if flush:
+            final = np.inf
+        if not final > self.time:
+            return [None] * n_modules
+        for readouts in self.readouts:
+            readouts.sort(key=lambda readout: readout[0])
+        starts = [np.array([r[0] for r in readouts], dtype=np.float64) for readouts in self.readouts]
+        stops = [np.array([r[1] for r in readouts], dtype=np.float64) for readouts in self.readouts]
+        # Every coincidence starts with the latest start of its readouts
+        points = np.unique(np.concatenate(starts))
+        points = points[(points >= self.time) & (points < final)]
+        index = np.empty(shape=(n_modules, points.shape[0]), dtype=np.intp)  # readout per module and coincidence
+        valid = np.ones(shape=points.shape[0], dtype=bool)
+        for i in range(n_modules):
+            if not starts[i].shape[0]:
+                valid[:] = False
+                break
+            index[i] = np.searchsorted(starts[i], points, side='right') - 1
+            valid &= (index[i] >= 0) & (stops[i][index[i]] >= points)
+        index = index[:, valid]
+        n_coincidences = index.shape[1]
+        module_clusters = []
+        for i, readouts in enumerate(self.readouts):
+            if not n_coincidences:
+                module_clusters.append(None)
+                continue
+            # Repeat the clusters of readouts that are part of several coincidences
+            lengths = np.array([r[2].shape[0] for r in readouts], dtype=np.intp)
+            first = np.cumsum(lengths) - lengths
+            counts = lengths[index[i]]
+            selection = np.repeat(first[index[i]] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            clusters = np.concatenate([r[2] for r in readouts])[selection]
+            clusters[:, 0] += np.repeat(np.arange(n_coincidences), counts) * _COINCIDENCE_KEY_STRIDE
+            module_clusters.append(clusters)
+        self.n_coincidences += n_coincidences
+        self.time = np.nextafter(self.latest.max(), np.inf) if flush else final
+        # Readouts that end before the final time cannot be part of new coincidences
+        self.readouts = [[r for r in readouts if r[1] >= self.time] for readouts in self.readouts]
+        return module_clusters
+
+
+class ReadoutBuffer(object):
+    ''' Preallocated ring buffer of decoded readouts of one module
+
+        Every slot holds the hits of one readout (at most max_hits) and its
+        start/stop timestamps. If the buffer is full the oldest readout is
+        overwritten and counted as dropped.
+    '''
+    def __init__(self, n_readouts, max_hits, dtype=np.int32):
+        self.hits = np.zeros(shape=(n_readouts, max_hits, 2), dtype=dtype)
+        self.n_hits = np.zeros(shape=n_readouts, dtype=np.int32)
+        self.timestamps = np.zeros(shape=(n_readouts, 2), dtype=np.float64)
+        self.index = 0  # next slot to write
+        self.n_readouts = 0  # number of filled slots
+        self.n_dropped = 0
+
+    def push(self, hits, timestamp=(np.nan, np.nan)):
+        n_hits = hits.shape[0]
+        self.hits[self.index, :n_hits] = hits
+        self.n_hits[self.index] = n_hits
+        self.timestamps[self.index] = timestamp
+        self.index = (self.index + 1) % self.n_hits.shape[0]
+        if self.n_readouts == self.n_hits.shape[0]:
+            self.n_dropped += 1
+        else:
+            self.n_readouts += 1
+
+    def pop(self):
+        ''' Hits and timestamps of all buffered readouts in arrival order
+
+            Returns None, None if empty
+        '''
+        if not self.n_readouts:
+            return None, None
+        slots = (self.index - self.n_readouts + np.arange(self.n_readouts)) % self.n_hits.shape[0]
+        valid = np.arange(self.hits.shape[1]) < self.n_hits[slots][:, np.newaxis]
+        self.n_readouts = 0
+        return self.hits[slots][valid], self.timestamps[slots]
+
+
+# One decoded readout: (start, stop) timestamp, (N, 2) col, row of all hits
+# that passed the noise mask and (K, 3) clusters (see IO.get_module_readouts)
+DecodedReadout = collections.namedtuple('DecodedReadout', ('timestamp', 'hits', 'clusters'))
 
 
 class IO(object):
-    ''' Analyze pybar data '''
-    def __init__(self, addresses, max_hits=100):
+    ''' Analyze pybar data
+
+        With threaded=True a receiver thread drains all sockets continuously
+        (round robin) and buffers the decoded readouts (at most buffer_size
+        per module) until they are fetched with get_module_hits.
+        With zero_copy=True the raw data array aliases the zmq message buffer
+        instead of copying the payload into a bytes object.
+        With clustering=True adjacent pixels are grouped and the cluster
+        centroids (float col, row) are returned instead of the pixel hits.
+        With processes=True every address is decoded in its own process
+        (see decoder_process) and only the decoded hits and clusters are
+        received, so decoding of several modules runs in parallel.
+        Hot pixels are masked per module (see NoiseMask), noise_masks are
+        optional mask file names per module that are loaded on start and
+        written on close.
+        The policy (one for all or one per module) selects the readouts that
+        are decoded: 'all' readouts, only the 'latest' readout if newer data
+        is already waiting or every sample_every-th readout ('sample').
+        Skipped readouts are counted. rcvhwm limits the number of readouts
+        queued by zmq per socket, newer readouts are lost if it is reached.
+        Lost readouts are counted as dropped if the sender numbers them (see
+        replay.send_data).
+    '''
+    def __init__(self, addresses, max_hits=100, threaded=False, buffer_size=1000, zero_copy=True, clustering=False,
+                 processes=False, noise_masks=None, policy='all', sample_every=10, rcvhwm=None, context=None):
         self.sockets = []
-        context = zmq.Context()
+        if context is None:
+            context = zmq.Context()
         self.max_hits = max_hits
-        self.last_hits = [[], []]
-        for address in addresses:
-            s = context.socket(zmq.SUB)  # subscriber
-            s.setsockopt(zmq.SUBSCRIBE, b'')  # do not filter any data
-            s.connect(address)
+        self.zero_copy = zero_copy
+        self.clustering = clustering
+        self.processes = processes
+        self.policies = [policy] * len(addresses) if isinstance(policy, str) else list(policy)
+        for p in self.policies:
+            if p not in _POLICIES:
+                raise ValueError('Unknown readout policy %s, use one of %s' % (p, ', '.join(_POLICIES)))
+        self.sample_every = sample_every
+        self.rcvhwm = rcvhwm
+        self.noise_mask_files = list(noise_masks) if noise_masks is not None else [None] * len(addresses)
+        self.noise_masks = []
+        if self.processes:
+            self._decoders = []
+            self._stop_decoders = multiprocessing.Event()
+        for address, noise_mask_file, p in zip(addresses, self.noise_mask_files, self.policies):
+            if self.processes:  # the decoder process has the noise mask and applies the policy
+                s = context.socket(zmq.PULL)
+                if rcvhwm is not None:
+                    s.setsockopt(zmq.RCVHWM, rcvhwm)
+                port = s.bind_to_random_port('tcp://127.0.0.1')
+                self._start_decoder(address, 'tcp://127.0.0.1:%d' % port, noise_mask_file, p)
+            else:
+                s = context.socket(zmq.SUB)  # subscriber
+                s.setsockopt(zmq.SUBSCRIBE, b'')  # do not filter any data
+                if rcvhwm is not None:
+                    s.setsockopt(zmq.RCVHWM, rcvhwm)  # has to be set before connect
+                s.connect(address)
             self.sockets.append(s)
+            self.noise_masks.append(NoiseMask(filename=noise_mask_file))
+        # Counters
+        self.n_received = [0] * len(self.sockets)
+        self.n_skipped = [0] * len(self.sockets)
+        self._n_dropped_forward = [0] * len(self.sockets)  # not forwarded by the decoder processes
+        self._n_dropped_readouts = [0] * len(self.sockets)  # decoded readouts not fetched before the buffer was full
+        self._n_lost = [0] * len(self.sockets)  # gaps of the sequence numbers of the sender
+        self._sequence = [None] * len(self.sockets)  # last received sequence number
+        self.n_raw_hits = [0] * len(self.sockets)  # decoded hits before the noise mask
+        self.n_hits = [0] * len(self.sockets)  # decoded hits after the noise mask, before max_hits
+        self.hit_counts = [np.zeros(_N_COLS * _N_ROWS, dtype=np.int64) for _ in self.sockets]  # per pixel, see n_hits
+        self.receive_time = [0.] * len(self.sockets)
+        self.decode_time = [0.] * len(self.sockets)
+
+        # Decoded readouts with all hits and clusters for track finding and recording
+        self.readouts = [collections.deque(maxlen=buffer_size) for _ in self.sockets]
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+
+        self.threaded = threaded
+        if self.threaded:
+            self._start_receiver()
+
+    def _start_receiver(self):
+        ''' Start the receiver thread that fills the readout buffers '''
+        dtype = np.float64 if self.clustering else np.int32
+        self.buffers = [ReadoutBuffer(self.buffer_size, self.max_hits, dtype=dtype) for _ in self.sockets]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stop_receiver(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _start_decoder(self, address, output_address, noise_mask_file=None, policy='all', timeout=10.):
+        ''' Start the decoder process of one address and wait until it is connected '''
+        ready = multiprocessing.Event()
+        io_kwargs = dict(max_hits=self.max_hits, clustering=self.clustering, noise_masks=[noise_mask_file],
+                         policy=policy, sample_every=self.sample_every, rcvhwm=self.rcvhwm)
+        p = multiprocessing.Process(target=decoder_process,
+                                    args=(address, output_address, io_kwargs, ready, self._stop_decoders))
+        p.daemon = True
+        p.start()
+        if not ready.wait(timeout):
+            raise RuntimeError('Decoder process of %s did not start' % address)
+        self._decoders.append(p)
+
+    @property
+    def n_dropped(self):
+        ''' Readouts per module that were dropped because a buffer was full
+
+            Includes the readouts that were lost before they were received
+            (e.g. at the zmq high water marks). A readout is counted for the
+            hit and for the decoded readout buffer if it was dropped by both.
+        '''
+        dropped = [f + r + l for f, r, l in zip(self._n_dropped_forward, self._n_dropped_readouts, self._n_lost)]
+        if self.threaded:
+            dropped = [d + b.n_dropped for d, b in zip(dropped, self.buffers)]
+        return dropped
+
+    @property
+    def n_queued(self):
+        ''' Decoded readouts per module waiting to be fetched (threaded mode only) '''
+        if not self.threaded:
+            return [0] * len(self.sockets)
+        return [b.n_readouts for b in self.buffers]
+
+    def stats(self):
+        ''' Counters per module since start
+
+            Received, skipped (by the policy), dropped and queued readouts,
+            decoded hits before (raw_hits) and after the noise mask (hits,
+            not limited by max_hits), masked hits and the time spent receiving
+            and decoding.
+        '''
+        return dict(received=list(self.n_received),
+                    skipped=list(self.n_skipped),
+                    dropped=self.n_dropped,
+                    queued=self.n_queued,
+                    raw_hits=list(self.n_raw_hits),
+                    hits=list(self.n_hits),
+                    masked=[m.n_masked for m in self.noise_masks],
+                    receive_time=list(self.receive_time),
+                    decode_time=list(self.decode_time))
+
+    def save_noise_masks(self):
+        ''' Write the noise masks of all modules with a mask file name
+
+            Called by close when the receiver is stopped, decoder processes
+            write their masks when they are stopped.
+        '''
+        if self.processes:
+            return
+        for noise_mask, filename in zip(self.noise_masks, self.noise_mask_files):
+            if filename is not None:
+                noise_mask.save(filename)
+
+    def close(self):
+        ''' Stop receiving and write the noise masks '''
+        if self.threaded:
+            self._stop_receiver()
+        if self.processes:
+            self._stop_decoders.set()
+            for p in self._decoders:
+                p.join()
+        self.save_noise_masks()  # no receiver fills the masks anymore
+        for socket in self.sockets:
+            socket.close()
+
+    def _recv_message(self, socket, flags=0):
+        ''' Receive one message
+
+            Returns the raw data words (None if the message is not readout
+            data) and the meta data. Raises zmq.Again if no message is
+            available in NOBLOCK mode.
+        '''
+        meta_data = socket.recv_json(flags=flags)
+        # print i, meta_data
+        if meta_data['name'] != 'ReadoutData':
+            return self._unpack_message(meta_data)
+        if self.zero_copy:
+            data = socket.recv(copy=False).buffer  # memoryview of the zmq frame
+        else:
+            data = socket.recv()
+        return self._unpack_message(meta_data, data)
+
+    def _unpack_message(self, meta_data, data=None):
+        ''' Raw data words (None if not readout data) and meta data of a received message '''
+        name = meta_data.pop('name')
+        if name == 'ReadoutData':
+            # Reconstruct numpy array
+            dtype = meta_data.pop('dtype')
+            shape = meta_data.pop('shape')
+            return np.frombuffer(data, dtype=dtype).reshape(shape), meta_data
+        elif name == 'Filename':
+            print('Start run for module', meta_data)
+        return None, meta_data
+
+    def _decode(self, i, words, max_hits, n_readouts=1, timestamp=(np.nan, np.nan)):
+        ''' Decode raw words of n_readouts readouts of module i and mask hot pixels
+
+            All hits and their clusters are stored with the (start, stop)
+            timestamp of the readouts (see get_module_readouts). Returns at
+            most max_hits hits and the DecodedReadout.
+        '''
+        t_start = time.time()
+        event_hits, triggers, bcids = event_hit_array(words)
+        self.n_raw_hits[i] += event_hits.shape[0]
+        keys = pixel_keys(event_hits[:, 1:])
+        counts = self.noise_masks[i].fill(keys, n_readouts=n_readouts)
+        event_hits = event_hits[self.noise_masks[i].apply(keys)]
+        self.n_hits[i] += event_hits.shape[0]
+        with self._lock:
+            np.add(self.hit_counts[i], counts, out=self.hit_counts[i], where=~self.noise_masks[i].mask)
+        clusters, _ = cluster_hits(event_hits)
+        clusters[:, 0] = event_keys(triggers, bcids)[clusters[:, 0].astype(np.intp)]
+        readout = DecodedReadout(timestamp, event_hits[:, 1:], clusters)
+        self._append_readout(i, readout)
+        self.decode_time[i] += time.time() - t_start
+        return self._shown_hits(readout, max_hits), readout
+
+    def _shown_hits(self, readout, max_hits):
+        ''' At most max_hits hits (or clusters with clustering) of a decoded readout '''
+        if self.clustering:
+            return np.ascontiguousarray(readout.clusters[:max_hits, 1:])
+        return np.ascontiguousarray(readout.hits[:max_hits])
+
+    def _append_readout(self, i, readout):
+        with self._lock:
+            if len(self.readouts[i]) == self.readouts[i].maxlen:  # the oldest readout is dropped
+                self._n_dropped_readouts[i] += 1
+            self.readouts[i].append(readout)
+
+    def _count_received(self, i, meta_data):
+        ''' Count a received readout and the readouts lost since the last one '''
+        self.n_received[i] += 1
+        sequence = meta_data.get('sequence')
+        if sequence is None:
+            return
+        if self._sequence[i] is not None and sequence > self._sequence[i]:  # a smaller number is a restart
+            self._n_lost[i] += sequence - self._sequence[i] - 1
+        self._sequence[i] = sequence
+
+    def _keep(self, i, socket):
+        ''' Apply the policy of module i to the last received readout
+
+            Returns False if the readout is skipped.
+        '''
+        if self.policies[i] == 'latest':
+            keep = not socket.getsockopt(zmq.EVENTS) & zmq.POLLIN  # no newer data waiting
+        elif self.policies[i] == 'sample':
+            keep = (self.n_received[i] - 1) % self.sample_every == 0
+        else:
+            keep = True
+        if not keep:
+            self.n_skipped[i] += 1
+        return keep
+
+    def _recv_decoded(self, i, socket, flags=0):
+        ''' Receive one message of module i from its decoder process
+
+            Returns the hit array and the DecodedReadout or None, None if the
+            message only carries counters.
+            Raises zmq.Again if no message is available in NOBLOCK mode.
+        '''
+        t_start = time.time()
+        meta_data = socket.recv_json(flags=flags)
+        data = []
+        while socket.getsockopt(zmq.RCVMORE):
+            data.append(socket.recv(copy=False).buffer)
+        self.receive_time[i] += time.time() - t_start
+        return self._unpack_decoded(i, meta_data, *data)
+
+    def _unpack_decoded(self, i, meta_data, hits_data=None, clusters_data=None):
+        ''' Hit array and DecodedReadout of a readout decoded by a decoder process
+
+            The counters of the decoder process since its last message are
+            added. Returns None, None for messages without a readout.
+        '''
+        self.n_received[i] += meta_data['n_received']
+        self.n_skipped[i] += meta_data['n_skipped']
+        self._n_dropped_forward[i] += meta_data['n_dropped']
+        self._n_lost[i] += meta_data['n_lost']
+        self.n_raw_hits[i] += meta_data['n_raw_hits']
+        self.n_hits[i] += meta_data['n_hits']
+        self.noise_masks[i].n_masked += meta_data['n_masked']
+        self.decode_time[i] += meta_data['decode_time']
+        if hits_data is None:
+            return None, None
+        timestamp = (meta_data['timestamp_start'], meta_data['timestamp_stop'])
+        readout = DecodedReadout(timestamp, np.frombuffer(hits_data, dtype=np.int32).reshape(-1, 2),
+                                 np.frombuffer(clusters_data, dtype=np.float64).reshape(-1, 3))
+        with self._lock:
+            self.hit_counts[i] += hit_counts(readout.hits)
+        self._append_readout(i, readout)
+        return self._shown_hits(readout, self.max_hits), readout
+
+    def _recv_readout(self, i, socket, flags=0):
+        ''' Receive and decode one message of module i
+
+            Returns the hit array and the DecodedReadout or None, None if the
+            message is not readout data.
+            Raises zmq.Again if no message is available in NOBLOCK mode.
+        '''
+        if self.processes:
+            return self._recv_decoded(i, socket, flags=flags)
+        t_start = time.time()
+        words, meta_data = self._recv_message(socket, flags=flags)
+        self.receive_time[i] += time.time() - t_start
+        if words is None:
+            return None, None
+        self._count_received(i, meta_data)
+        if not self._keep(i, socket):
+            return None, None
+        timestamp = (meta_data.get('timestamp_start', np.nan), meta_data.get('timestamp_stop', np.nan))
+        return self._decode(i, words, max_hits=self.max_hits, timestamp=timestamp)
+
+    def _recv_batch(self, i, socket, max_messages, max_bytes):
+        ''' Drain pending messages of module i and decode them at once
+
+            Stops after max_messages readouts or max_bytes of raw data.
+            Returns the hit array and an (N, 2) array of readout timestamps
+            (start, stop) or None, None if no readout data was pending.
+        '''
+        if self.processes:  # already decoded, only join the readouts
+            hits, timestamps = [], []
+            while len(hits) < max_messages:
+                try:
+                    h, readout = self._recv_decoded(i, socket, flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if h is None:
+                    continue
+                hits.append(h)
+                timestamps.append(readout.timestamp)
+            if not hits:
+                return None, None
+            return np.concatenate(hits), np.array(timestamps, dtype=np.float64)
+        words, timestamps = [], []
+        n_bytes = 0
+        t_start = time.time()
+        while len(words) < max_messages and n_bytes < max_bytes:
+            try:
+                data_array, meta_data = self._recv_message(socket, flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if data_array is not None:
+                self._count_received(i, meta_data)
+                if not self._keep(i, socket):
+                    continue
+                words.append(data_array)
+                timestamps.append((meta_data.get('timestamp_start', np.nan), meta_data.get('timestamp_stop', np.nan)))
+                n_bytes += data_array.nbytes
+        self.receive_time[i] += time.time() - t_start
+        if not words:
+            return None, None
+        timestamps = np.array(timestamps, dtype=np.float64)
+        # The clusters of the batch get the time window of all its readouts
+        h, _ = self._decode(i, np.concatenate(words), max_hits=self.max_hits * len(words), n_readouts=len(words),
+                            timestamp=(timestamps[:, 0].min(), timestamps[:, 1].max()))
+        return h, timestamps
+
+    def _receive(self):
+        ''' Receiver thread: drain all sockets into the readout buffers
+
+            At most _RECEIVE_BURST readouts of every ready socket are received
+            per round, sockets with more pending data are polled again.
+        '''
+        poller = zmq.Poller()
+        for socket in self.sockets:
+            poller.register(socket, zmq.POLLIN)
+        while not self._stop.is_set():
+            for socket, _ in poller.poll(timeout=100):
+                i = self.sockets.index(socket)
+                for _ in range(_RECEIVE_BURST):
+                    try:
+                        h, readout = self._recv_readout(i, socket, flags=zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    if h is not None:
+                        with self._lock:
+                            self.buffers[i].push(h, readout.timestamp)
 
     def get_module_hits(self):
-        ''' Called on app update to fetch zmq data '''
+        ''' Called on app update to fetch zmq data
+
+            Returns per module an (N, 2) array of col, row hits or None
+        '''
+        if self.threaded:
+            with self._lock:
+                return [b.pop()[0] for b in self.buffers]
         hits = []
         for i, socket in enumerate(self.sockets):
             try:
-                meta_data = socket.recv_json(flags=zmq.NOBLOCK)
-                # print i, meta_data
+                hits.append(self._recv_readout(i, socket, flags=zmq.NOBLOCK)[0])
             except zmq.Again:
                 hits.append(None)
-                pass
-            else:
-                name = meta_data.pop('name')
-                if name == 'ReadoutData':
-                    data = socket.recv()
-                    # Reconstruct numpy array
-                    dtype = meta_data.pop('dtype')
-                    shape = meta_data.pop('shape')
-                    data_array = np.frombuffer(data, dtype=dtype).reshape(shape) 
-                    h = col_row_pairs(data_array, max_hits=self.max_hits, noise_hits=self.last_hits[i])
-                    # if h:
-                    #     print i, "HITS", h
-                    self.last_hits[i] = (h + self.last_hits[i])[:self.max_hits]
-                    hits.append(h)
-                    #print "noise_hits", self.last_hits[i]
-                elif name == 'Filename':
-                    hits.append(None)
-                    print('Start run for module', meta_data)
         return hits
+
+    def get_module_readouts(self):
+        ''' Decoded readouts received since the last call
+
+            Returns per module a list of DecodedReadout in arrival order,
+            with all hits that passed the noise mask, e.g. for recording
+            and CoincidenceBuffer.push. Batches of get_module_batches are one
+            readout with the time window of all their readouts.
+        '''
+        with self._lock:
+            module_readouts = [list(readouts) for readouts in self.readouts]
+            for readouts in self.readouts:
+                readouts.clear()
+        return module_readouts
+
+    def get_module_hit_counts(self):
+        ''' Hits per pixel of every module since the last call
+
+            All decoded hits that passed the noise mask are counted, not
+            only the shown ones. Returns per module an array indexed by the
+            pixel keys (see pixel_keys).
+        '''
+        with self._lock:
+            module_hit_counts = [counts.copy() for counts in self.hit_counts]
+            for counts in self.hit_counts:
+                counts[:] = 0
+        return module_hit_counts
+
+    def get_module_batches(self, max_messages=100, max_bytes=1 << 20):
+        ''' Fetch all pending readouts at once
+
+            Drains up to max_messages readouts or max_bytes of raw data per
+            module and decodes them in one go. Returns a list of (N, 2) hit
+            arrays and a list of (M, 2) arrays with the start/stop timestamps
+            of the M readouts, both None for modules without data.
+        '''
+        if self.threaded:
+            with self._lock:
+                batches = [b.pop() for b in self.buffers]
+        else:
+            batches = [self._recv_batch(i, socket, max_messages, max_bytes) for i, socket in enumerate(self.sockets)]
+        return [b[0] for b in batches], [b[1] for b in batches]
+
+
+def decoder_process(address, output_address, io_kwargs, ready, stop):
+    ''' Decode the pyBAR data of one address and push the results to output_address
+
+        Target of the processes started by IO with processes=True. Every
+        readout is forwarded as a json header with the counters since the
+        last message followed by the (N, 2) array of all hits and the (K, 3)
+        cluster array (see DecodedReadout). Readouts are dropped if the
+        receiver does not keep up. Without new data the counters are sent
+        alone. io_kwargs are the IO options of the module.
+    '''
+    context = zmq.Context()
+    io = IO([address], context=context, **io_kwargs)
+    output = context.socket(zmq.PUSH)
+    output.connect(output_address)
+    socket = io.sockets[0]
+    n_dropped = 0  # readouts not forwarded
+
+    def counters():
+        return dict(n_received=io.n_received[0], n_skipped=io.n_skipped[0], n_dropped=n_dropped, n_lost=io._n_lost[0],
+                    n_raw_hits=io.n_raw_hits[0], n_hits=io.n_hits[0], n_masked=io.noise_masks[0].n_masked,
+                    decode_time=io.decode_time[0])
+
+    def since(reported):
+        current = counters()
+        return current, dict((name, current[name] - reported[name]) for name in current)
+    reported = counters()  # counters of the last sent message
+    ready.set()
+    while not stop.is_set():
+        if not socket.poll(timeout=100):
+            current, meta_data = since(reported)
+            if current != reported:  # idle, report the last skipped, dropped and lost readouts
+                try:
+                    output.send_json(meta_data, flags=zmq.NOBLOCK)
+                    reported = current
+                except zmq.Again:
+                    pass
+            continue
+        while True:
+            try:
+                h, readout = io._recv_readout(0, socket, flags=zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if h is None:  # skipped readouts are reported with the next message
+                continue
+            io.get_module_readouts()  # only forwarded
+            current, meta_data = since(reported)
+            meta_data.update(timestamp_start=readout.timestamp[0], timestamp_stop=readout.timestamp[1])
+            try:
+                output.send_json(meta_data, flags=zmq.SNDMORE | zmq.NOBLOCK)
+            except zmq.Again:
+                n_dropped += 1
+                continue
+            reported = current
+            output.send(np.ascontiguousarray(readout.hits), flags=zmq.SNDMORE)  # following parts never block
+            output.send(np.ascontiguousarray(readout.clusters))
+    io.close()
+    output.close(linger=0)
+    context.term()
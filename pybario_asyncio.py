@@ -0,0 +1,171 @@
+''' asyncio front end of pybario.IO
+
+    All module sockets are awaited concurrently in one event loop and every
+    decoded readout is decoded once and shared with any number of consumers:
+
+        io = AsyncIO(addresses)
+        asyncio.ensure_future(io.run())
+        async for readout in io.subscribe():
+            print(readout.module, readout.hits.shape)
+
+    Instead of running it in an existing loop the receiver runs in an own
+    loop in a thread (own_thread=True) or the own loop is stepped from
+    another loop, e.g. with pyglet.clock.schedule(io.step). The readouts are
+    also buffered for get_module_hits, get_module_batches and
+    get_module_readouts of pybario.IO.
+'''
+
+import asyncio
+import collections
+import json
+import threading
+import time
+
+import zmq
+import zmq.asyncio
+import numpy as np
+
+import pybario
+
+_MAX_STEP_TIME = 0.01  # seconds step runs the event loop at most, keeps the frame rate of the caller
+
+Readout = collections.namedtuple('Readout', ('module', 'hits', 'clusters', 'timestamp'))
+
+
+class Subscription(object):
+    ''' Async iterator over the decoded readouts of an AsyncIO
+
+        At most maxsize readouts are queued, the oldest readout is dropped
+        if the consumer does not keep up. Has to be iterated in the event
+        loop of the AsyncIO.
+    '''
+    def __init__(self, io, maxsize):
+        self.io = io
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.n_dropped = 0
+
+    def put(self, readout):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.n_dropped += 1
+        self.queue.put_nowait(readout)
+
+    def close(self):
+        ''' Stop receiving readouts '''
+        if self in self.io._subscribers:
+            self.io._subscribers.remove(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        readout = await self.queue.get()
+        if readout is None:  # AsyncIO was closed
+            raise StopAsyncIteration
+        return readout
+
+
+class AsyncIO(pybario.IO):
+    ''' pybario.IO with an asyncio receiver
+
+        Takes the options of pybario.IO except threaded and context. With
+        own_thread=True the event loop runs in a background thread,
+        otherwise step has to be called regularly. It runs the event loop
+        while data is pending, at most _MAX_STEP_TIME seconds.
+        Subscriptions queue at most queue_size readouts.
+    '''
+    def __init__(self, addresses, own_thread=False, queue_size=1000, **kwargs):
+        pybario.IO.__init__(self, addresses, threaded=False, context=zmq.asyncio.Context(), **kwargs)
+        self.queue_size = queue_size
+        self.loop = asyncio.new_event_loop()
+        self._subscribers = []
+        self._task = None
+        # Readouts are always buffered for the get_module_* methods
+        self.threaded = True
+        dtype = np.float64 if self.clustering else np.int32
+        self.buffers = [pybario.ReadoutBuffer(self.buffer_size, self.max_hits, dtype=dtype) for _ in self.sockets]
+        self._stop = threading.Event()
+        self._thread = None
+        if own_thread:
+            self._thread = threading.Thread(target=self._receive)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def subscribe(self, maxsize=None):
+        ''' New async iterator over all readouts decoded from now on '''
+        subscription = Subscription(self, maxsize if maxsize is not None else self.queue_size)
+        self._subscribers.append(subscription)
+        return subscription
+
+    def __aiter__(self):
+        return self.subscribe()
+
+    def step(self, dt=None):
+        ''' Run the event loop until no socket has pending data, dt is ignored (pyglet clock callback) '''
+        if self._stop.is_set():  # closed
+            return
+        if self._task is None:
+            self._task = self.loop.create_task(self.run())
+        t_stop = time.time() + _MAX_STEP_TIME
+        while True:
+            self.loop.call_soon(self.loop.stop)
+            self.loop.run_forever()
+            if time.time() > t_stop or not any(socket.getsockopt(zmq.EVENTS) & zmq.POLLIN for socket in self.sockets):
+                break
+
+    def _receive(self):
+        ''' Receiver thread: run the event loop until close '''
+        asyncio.set_event_loop(self.loop)
+        self._task = self.loop.create_task(self.run())
+        self.loop.run_until_complete(self._task)
+
+    def _stop_receiver(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        elif self._task is not None:
+            self.loop.run_until_complete(self._task)
+        self.loop.close()
+
+    async def run(self):
+        ''' Receive, decode and distribute the readouts of all modules until close '''
+        poller = zmq.asyncio.Poller()
+        for socket in self.sockets:
+            poller.register(socket, zmq.POLLIN)
+        while not self._stop.is_set():
+            for socket, _ in await poller.poll(timeout=100):
+                i = self.sockets.index(socket)
+                readout = await self._recv(i, socket)
+                if readout is None:
+                    continue
+                with self._lock:
+                    self.buffers[i].push(readout.hits, readout.timestamp)
+                for subscription in self._subscribers:
+                    subscription.put(readout)
+        for subscription in self._subscribers:
+            subscription.put(None)
+
+    async def _recv(self, i, socket):
+        ''' Receive and decode one message of module i
+
+            Returns a Readout or None if the message is not readout data or
+            skipped by the policy.
+        '''
+        t_start = time.time()
+        frames = await socket.recv_multipart(copy=False)
+        self.receive_time[i] += time.time() - t_start
+        meta_data = json.loads(frames[0].bytes)
+        if self.processes:
+            h, readout = self._unpack_decoded(i, meta_data, *[frame.buffer for frame in frames[1:]])
+            if h is None:  # counters only
+                return None
+        else:
+            words, meta_data = self._unpack_message(meta_data, frames[1].buffer if len(frames) > 1 else None)
+            if words is None:
+                return None
+            self._count_received(i, meta_data)
+            if not self._keep(i, socket):
+                return None
+            timestamp = (meta_data.get('timestamp_start', np.nan), meta_data.get('timestamp_stop', np.nan))
+            h, readout = self._decode(i, words, max_hits=self.max_hits, timestamp=timestamp)
+        return Readout(i, h, readout.clusters, readout.timestamp)
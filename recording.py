@@ -0,0 +1,172 @@
+''' Recording of the decoded readouts and the found tracks for later analysis and replay
+
+    A recording is a compressed HDF5 file with one table per data type.
+    Every decoded readout of pybario.IO (see pybario.DecodedReadout) is one
+    row of the readouts table with the row ranges of its hits and clusters,
+    all hits that passed the noise mask are recorded, not only the shown
+    ones:
+
+        readouts: time (wall clock of the fetch), module, timestamp_start,
+                  timestamp_stop, hit_start, hit_stop, cluster_start, cluster_stop
+        hits: readout, module, col, row
+        clusters: readout, module, event, col, row
+        tracks: time (wall clock), readout_start, readout_stop, chi2, angle,
+                col_row (col, row of every plane)
+'''
+
+import time
+
+import numpy as np
+import tables as tb
+
+import pybario
+
+_FILTERS = tb.Filters(complib='blosc', complevel=5)
+_CHUNK_SIZE = 1000  # readouts read at once during replay
+_READOUT_DTYPE = np.dtype([('time', np.float64), ('module', np.uint8), ('timestamp_start', np.float64),
+                           ('timestamp_stop', np.float64), ('hit_start', np.uint64), ('hit_stop', np.uint64),
+                           ('cluster_start', np.uint64), ('cluster_stop', np.uint64)])
+_HIT_DTYPE = np.dtype([('readout', np.uint64), ('module', np.uint8), ('col', np.uint8), ('row', np.uint16)])
+_CLUSTER_DTYPE = np.dtype([('readout', np.uint64), ('module', np.uint8), ('event', np.int64), ('col', np.float32),
+                           ('row', np.float32)])
+
+
+def _track_dtype(n_planes):
+    return np.dtype([('time', np.float64), ('readout_start', np.float64), ('readout_stop', np.float64),
+                     ('chi2', np.float32), ('angle', np.float32), ('col_row', np.float32, (n_planes, 2))])
+
+
+class Recorder(object):
+    ''' Append the received readouts and the tracks found in them to a recording file '''
+    def __init__(self, filename, n_planes):
+        self.n_planes = n_planes
+        self.n_readouts, self.n_hits, self.n_clusters = 0, 0, 0
+        self.out_file = tb.open_file(filename, mode='w', title='Telescope recording')
+        self.out_file.root._v_attrs.n_planes = n_planes
+        self.readouts = self.out_file.create_table(self.out_file.root, 'readouts', description=_READOUT_DTYPE,
+                                                   filters=_FILTERS)
+        self.hits = self.out_file.create_table(self.out_file.root, 'hits', description=_HIT_DTYPE, filters=_FILTERS,
+                                               expectedrows=10000000)
+        self.clusters = self.out_file.create_table(self.out_file.root, 'clusters', description=_CLUSTER_DTYPE,
+                                                   filters=_FILTERS, expectedrows=10000000)
+        self.tracks = self.out_file.create_table(self.out_file.root, 'tracks', description=_track_dtype(n_planes),
+                                                 filters=_FILTERS)
+
+    def record_readouts(self, module_readouts):
+        ''' Append the readouts fetched at once, per module lists of pybario.DecodedReadout '''
+        readouts = [(i, readout) for i, one_module_readouts in enumerate(module_readouts) for readout in one_module_readouts]
+        if not readouts:
+            return
+        rows = np.empty(shape=len(readouts), dtype=_READOUT_DTYPE)
+        rows['time'] = time.time()
+        hits = np.empty(shape=sum(r.hits.shape[0] for _, r in readouts), dtype=_HIT_DTYPE)
+        clusters = np.empty(shape=sum(r.clusters.shape[0] for _, r in readouts), dtype=_CLUSTER_DTYPE)
+        hit_index, cluster_index = 0, 0
+        for n, (i, readout) in enumerate(readouts):
+            n_hits, n_clusters = readout.hits.shape[0], readout.clusters.shape[0]
+            rows['module'][n] = i
+            rows['timestamp_start'][n], rows['timestamp_stop'][n] = readout.timestamp
+            rows['hit_start'][n], rows['hit_stop'][n] = self.n_hits + hit_index, self.n_hits + hit_index + n_hits
+            rows['cluster_start'][n] = self.n_clusters + cluster_index
+            rows['cluster_stop'][n] = self.n_clusters + cluster_index + n_clusters
+            selection = slice(hit_index, hit_index + n_hits)
+            hits['readout'][selection] = self.n_readouts + n
+            hits['module'][selection] = i
+            hits['col'][selection] = readout.hits[:, 0]
+            hits['row'][selection] = readout.hits[:, 1]
+            selection = slice(cluster_index, cluster_index + n_clusters)
+            clusters['readout'][selection] = self.n_readouts + n
+            clusters['module'][selection] = i
+            clusters['event'][selection] = readout.clusters[:, 0]
+            clusters['col'][selection] = readout.clusters[:, 1]
+            clusters['row'][selection] = readout.clusters[:, 2]
+            hit_index += n_hits
+            cluster_index += n_clusters
+        self.readouts.append(rows)
+        self.hits.append(hits)
+        self.clusters.append(clusters)
+        self.n_readouts += rows.shape[0]
+        self.n_hits += hits.shape[0]
+        self.n_clusters += clusters.shape[0]
+
+    def record_tracks(self, tracks, chi2, angles, readout_time=None):
+        ''' Append tracks, chi2 and angles as returned by TrackFinder.find_tracks
+
+            readout_time is the (start, stop) timestamp of their readouts.
+        '''
+        if tracks is None or not tracks.shape[0]:
+            return
+        rows = np.empty(shape=tracks.shape[0], dtype=self.tracks.dtype)
+        rows['time'] = time.time()
+        rows['readout_start'], rows['readout_stop'] = readout_time if readout_time is not None else (np.nan, np.nan)
+        rows['chi2'] = chi2
+        rows['angle'] = angles
+        rows['col_row'] = tracks
+        self.tracks.append(rows)
+
+    def close(self):
+        self.out_file.close()
+
+
+def read_readouts(filename, chunk_size=_CHUNK_SIZE):
+    ''' Iterate over the readouts of a recording
+
+        Yields the wall clock time of the fetch, the module and the
+        pybario.DecodedReadout of every readout. The tables are read in
+        chunks of chunk_size readouts and their hit and cluster row ranges.
+    '''
+    with tb.open_file(filename) as in_file:
+        for start in range(0, in_file.root.readouts.nrows, chunk_size):
+            readouts = in_file.root.readouts.read(start, start + chunk_size)
+            hit_offset, cluster_offset = int(readouts['hit_start'][0]), int(readouts['cluster_start'][0])
+            hits = in_file.root.hits.read(hit_offset, int(readouts['hit_stop'][-1]))
+            clusters = in_file.root.clusters.read(cluster_offset, int(readouts['cluster_stop'][-1]))
+            for readout in readouts:
+                readout_hits = hits[int(readout['hit_start']) - hit_offset:int(readout['hit_stop']) - hit_offset]
+                readout_clusters = clusters[int(readout['cluster_start']) - cluster_offset:
+                                            int(readout['cluster_stop']) - cluster_offset]
+                yield readout['time'], readout['module'], pybario.DecodedReadout(
+                    (readout['timestamp_start'], readout['timestamp_stop']),
+                    np.column_stack((readout_hits['col'], readout_hits['row'])).astype(np.int32),
+                    np.column_stack((readout_clusters['event'], readout_clusters['col'],
+                                     readout_clusters['row'])).astype(np.float64))
+
+
+class Player(object):
+    ''' Readouts of a recording with their recorded timing
+
+        The replay clock only advances with advance, e.g. by the frame time
+        of the application or by a fixed time step for reproducible runs.
+    '''
+    def __init__(self, filename):
+        with tb.open_file(filename) as in_file:
+            self.n_planes = in_file.root._v_attrs.n_planes
+        self.readouts = read_readouts(filename)
+        self.readout = next(self.readouts, None)
+        self.start = self.readout[0] if self.readout is not None else 0.
+        self.time = 0.
+        self.n_readouts = 0  # readouts returned so far
+
+    @property
+    def finished(self):
+        return self.readout is None
+
+    def advance(self, dt):
+        ''' Advance the replay clock by dt and return the readouts that are due
+
+            Returns per module a list of pybario.DecodedReadout like
+            pybario.IO.get_module_readouts.
+        '''
+        self.time += dt
+        module_readouts = [[] for _ in range(self.n_planes)]
+        while self.readout is not None and self.readout[0] - self.start <= self.time:
+            _, module, readout = self.readout
+            module_readouts[module].append(readout)
+            self.n_readouts += 1
+            self.readout = next(self.readouts, None)
+        return module_readouts
+
+    def close(self):
+        ''' Close the recording file '''
+        self.readouts.close()
+        self.readout = None
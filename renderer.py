@@ -0,0 +1,265 @@
+''' Instanced drawing of fading hits and tracks with an OpenGL shader program
+
+    Every hit quad or track line is one instance with its position and
+    birth time as per instance vertex attributes. The fading is computed in
+    the vertex shader from a time uniform, thus the CPU only writes new
+    objects to the GPU and does no work per object and frame. The fixed
+    function matrices (glTranslatef, glRotatef, ...) and the blending state
+    apply as for the vertex lists of main.py. Needs OpenGL 3.3, see
+    supported.
+'''
+
+import ctypes
+
+import numpy as np
+
+from pyglet.gl import *
+
+_VERTEX_SHADER = '''#version 150 compatibility
+in vec2 corner;  // per vertex
+in vec3 position;  // per instance
+in vec3 position_2;  // per instance, second line point
+in float birth;  // per instance
+uniform float time;
+uniform float fade_speed;
+uniform float transparency;
+uniform float max_transparency;
+uniform vec2 size;
+uniform float line_length;
+out float alpha;
+
+void main()
+{
+    float t = min(transparency + (time - birth) * fade_speed, max_transparency);
+    alpha = (255. - t) / 255.;
+    vec3 vertex;
+    if (line_length > 0.)  // line through both points, corner.x is the end
+        vertex = position + (2. * corner.x - 1.) * line_length * (position - position_2);
+    else  // quad [x, x + size.x] x [y, y + size.y]
+        vertex = position + vec3(corner * size, 0.);
+    gl_Position = gl_ModelViewProjectionMatrix * vec4(vertex, 1.);
+    if (alpha <= 0. || birth < -1e37)  // expired or empty, move out of the clip volume
+        gl_Position = vec4(2., 2., 2., 1.);
+}
+'''
+
+_FRAGMENT_SHADER = '''#version 150 compatibility
+in float alpha;
+uniform vec3 color;
+out vec4 frag_color;
+
+void main()
+{
+    frag_color = vec4(color, alpha);
+}
+'''
+
+_EMPTY = -1e38  # birth time of empty slots
+
+# Generic attributes start at 1, 0 aliases the fixed function vertex position
+_ATTRIBUTES = ('corner', 'position', 'position_2', 'birth')
+
+
+def supported():
+    ''' True if the current OpenGL context can run the shader renderer '''
+    return gl_info.have_version(3, 3)
+
+
+def _compile(source, shader_type):
+    shader = glCreateShader(shader_type)
+    buffer = ctypes.create_string_buffer(source.encode('ascii'))
+    sources = ctypes.cast(ctypes.pointer(ctypes.pointer(buffer)), ctypes.POINTER(ctypes.POINTER(GLchar)))
+    glShaderSource(shader, 1, sources, None)
+    glCompileShader(shader)
+    status = GLint(0)
+    glGetShaderiv(shader, GL_COMPILE_STATUS, ctypes.byref(status))
+    if not status.value:
+        log = ctypes.create_string_buffer(4096)
+        glGetShaderInfoLog(shader, len(log), None, log)
+        glDeleteShader(shader)
+        raise RuntimeError('Shader compilation failed: %s' % log.value.decode())
+    return shader
+
+
+class ShaderProgram(object):
+    ''' Vertex and fragment shader with the generic attributes of _ATTRIBUTES '''
+
+    def __init__(self, vertex_source=_VERTEX_SHADER, fragment_source=_FRAGMENT_SHADER):
+        self.program = glCreateProgram()
+        shaders = [_compile(vertex_source, GL_VERTEX_SHADER), _compile(fragment_source, GL_FRAGMENT_SHADER)]
+        for shader in shaders:
+            glAttachShader(self.program, shader)
+        self.attributes = {}
+        for i, name in enumerate(_ATTRIBUTES):
+            self.attributes[name] = i + 1
+            glBindAttribLocation(self.program, i + 1, name.encode('ascii'))
+        glLinkProgram(self.program)
+        for shader in shaders:
+            glDetachShader(self.program, shader)
+            glDeleteShader(shader)
+        status = GLint(0)
+        glGetProgramiv(self.program, GL_LINK_STATUS, ctypes.byref(status))
+        if not status.value:
+            log = ctypes.create_string_buffer(4096)
+            glGetProgramInfoLog(self.program, len(log), None, log)
+            raise RuntimeError('Shader linking failed: %s' % log.value.decode())
+        self._uniforms = {}
+
+    def uniform(self, name):
+        ''' Location of a uniform, -1 if it is not used by the shaders '''
+        if name not in self._uniforms:
+            self._uniforms[name] = glGetUniformLocation(self.program, name.encode('ascii'))
+        return self._uniforms[name]
+
+
+_program = None  # shared by all instance buffers of the context
+
+
+def _shared_program():
+    global _program
+    if _program is None:
+        _program = ShaderProgram()
+    return _program
+
+
+def _array_buffer(data, usage=GL_STATIC_DRAW):
+    buffer_id = GLuint(0)
+    glGenBuffers(1, ctypes.byref(buffer_id))
+    glBindBuffer(GL_ARRAY_BUFFER, buffer_id)
+    glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data, usage)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    return buffer_id
+
+
+class FadingInstances(object):
+    ''' GPU ring buffer of capacity equally colored fading objects
+
+        Objects get the transparency 'transparency' when added, it increases
+        by fade_speed per second up to max_transparency and the object
+        disappears above 255, like main.FadingStore. The clock only
+        advances with update. New objects overwrite the oldest ones.
+        Needs a current OpenGL context.
+    '''
+    _fields = ()  # per instance attributes (name, components)
+    _corners = np.zeros(shape=(0, 2), dtype=np.float32)
+    _mode = GL_TRIANGLE_STRIP
+
+    def __init__(self, capacity, color, fade_speed, transparency=100., max_transparency=None):
+        self.capacity = capacity
+        self.color = tuple(c / 255. for c in color)
+        self.fade_speed = fade_speed
+        self.transparency = transparency
+        self.max_transparency = 256. if max_transparency is None else max_transparency
+        self.time = 0.
+        self.index = 0  # ring position of the oldest object
+        self.program = _shared_program()
+        self._n_floats = sum(n for _, n in self._fields) + 1  # + birth time
+        self._corner_buffer = _array_buffer(self._corners)
+        self._instance_buffer = _array_buffer(self._empty(), usage=GL_DYNAMIC_DRAW)
+
+    def _empty(self):
+        empty = np.zeros(shape=(self.capacity, self._n_floats), dtype=np.float32)
+        empty[:, -1] = _EMPTY
+        return empty
+
+    def add(self, *fields):
+        ''' Add objects with the arrays (N, components) of the per instance fields
+
+            Only the new objects are written to the GPU, at most two buffer
+            updates if they wrap around the end of the ring buffer.
+        '''
+        n = min(len(fields[0]), self.capacity)
+        if not n:
+            return
+        data = np.empty(shape=(n, self._n_floats), dtype=np.float32)
+        column = 0
+        for values, (_, components) in zip(fields, self._fields):
+            data[:, column:column + components] = np.asarray(values).reshape(-1, components)[-n:]
+            column += components
+        data[:, -1] = self.time
+        glBindBuffer(GL_ARRAY_BUFFER, self._instance_buffer)
+        first = min(n, self.capacity - self.index)
+        row_bytes = self._n_floats * 4
+        glBufferSubData(GL_ARRAY_BUFFER, self.index * row_bytes, first * row_bytes, data.ctypes.data)
+        if n > first:
+            glBufferSubData(GL_ARRAY_BUFFER, 0, (n - first) * row_bytes, data[first:].ctypes.data)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.index = (self.index + n) % self.capacity
+
+    def update(self, dt):
+        self.time += dt
+
+    def clear(self):
+        empty = self._empty()
+        glBindBuffer(GL_ARRAY_BUFFER, self._instance_buffer)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, empty.nbytes, empty.ctypes.data)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def _set_uniforms(self):
+        program = self.program
+        glUniform1f(program.uniform('time'), self.time)
+        glUniform1f(program.uniform('fade_speed'), self.fade_speed)
+        glUniform1f(program.uniform('transparency'), self.transparency)
+        glUniform1f(program.uniform('max_transparency'), self.max_transparency)
+        glUniform3f(program.uniform('color'), *self.color)
+        glUniform1f(program.uniform('line_length'), 0.)
+
+    def draw(self):
+        ''' Draw all objects with one instanced draw call '''
+        attributes = self.program.attributes
+        glUseProgram(self.program.program)
+        self._set_uniforms()
+        glBindBuffer(GL_ARRAY_BUFFER, self._corner_buffer)
+        glEnableVertexAttribArray(attributes['corner'])
+        glVertexAttribPointer(attributes['corner'], 2, GL_FLOAT, GL_FALSE, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, self._instance_buffer)
+        offset = 0
+        used = [attributes['corner']]
+        for name, components in self._fields + (('birth', 1), ):
+            location = attributes[name]
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, components, GL_FLOAT, GL_FALSE, self._n_floats * 4, ctypes.c_void_p(offset))
+            glVertexAttribDivisor(location, 1)
+            used.append(location)
+            offset += components * 4
+        glDrawArraysInstanced(self._mode, 0, self._corners.shape[0], self.capacity)
+        # Restore the state for the fixed function drawing of pyglet
+        for location in used:
+            glVertexAttribDivisor(location, 0)
+            glDisableVertexAttribArray(location)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glUseProgram(0)
+
+    def delete(self):
+        glDeleteBuffers(1, ctypes.byref(self._corner_buffer))
+        glDeleteBuffers(1, ctypes.byref(self._instance_buffer))
+
+
+class InstancedQuads(FadingInstances):
+    ''' Fading quads [x, x + size] x [y, y + size] at height z, added with add((N, 3) positions) '''
+    _fields = (('position', 3), )
+    _corners = np.array([(0, 0), (1, 0), (0, 1), (1, 1)], dtype=np.float32)
+    _mode = GL_TRIANGLE_STRIP
+
+    def __init__(self, capacity, color, fade_speed, size, **kwargs):
+        FadingInstances.__init__(self, capacity, color, fade_speed, **kwargs)
+        self.size = size
+
+    def _set_uniforms(self):
+        FadingInstances._set_uniforms(self)
+        glUniform2f(self.program.uniform('size'), self.size, self.size)
+
+
+class InstancedLines(FadingInstances):
+    ''' Fading long lines through two points, added with add((N, 3) points, (N, 3) points) '''
+    _fields = (('position', 3), ('position_2', 3))
+    _corners = np.array([(0, 0), (1, 0)], dtype=np.float32)
+    _mode = GL_LINES
+
+    def __init__(self, capacity, color, fade_speed, line_length=1000., **kwargs):
+        FadingInstances.__init__(self, capacity, color, fade_speed, **kwargs)
+        self.line_length = line_length
+
+    def _set_uniforms(self):
+        FadingInstances._set_uniforms(self)
+        glUniform1f(self.program.uniform('line_length'), self.line_length)
@@ -1,10 +1,13 @@
 ''' Replay existing file to test the data visualization.
 '''
 
+import argparse
+import heapq
 import threading
 import time
 
 import zmq
+import numpy as np
 import tables as tb
 
 # Copied from pybar.daq.fei4_raw_data
@@ -20,9 +23,28 @@ def send_meta_data(socket, conf, name):
     except zmq.Again:
         pass
 
+def publisher(address, context=None):
+    ''' Bound publisher socket that reports full send queues
+
+        A PUB socket drops readouts silently if the queue of a subscriber is
+        full. The XPUB socket with XPUB_NODROP raises zmq.Again instead, thus
+        send_data can count the dropped readouts.
+    '''
+    if context is None:
+        context = zmq.Context.instance()
+    socket = context.socket(zmq.XPUB)
+    socket.setsockopt(zmq.XPUB_NODROP, 1)
+    socket.bind(address)
+    return socket
+
+
 # Copied from pybar.daq.fei4_raw_data
-def send_data(socket, data, scan_parameters={}, name='ReadoutData'):
+def send_data(socket, data, scan_parameters={}, name='ReadoutData', sequence=None):
     '''Sends the data of every read out (raw data and meta data) via ZeroMQ to a specified socket
+
+       Returns False if the data was dropped because the send queue is full
+       (only reported by sockets of publisher). sequence is the readout
+       number of the stream, the receiver counts the gaps as lost readouts.
     '''
     if not scan_parameters:
         scan_parameters = {}
@@ -35,21 +57,40 @@ def send_data(socket, data, scan_parameters={}, name='ReadoutData'):
         readout_error=data[3],  # int
         scan_parameters=scan_parameters  # dict
     )
+    if sequence is not None:
+        data_meta_data['sequence'] = sequence  # int
     try:
         socket.send_json(data_meta_data, flags=zmq.SNDMORE | zmq.NOBLOCK)
         socket.send(data[0], flags=zmq.NOBLOCK)  # PyZMQ supports sending numpy arrays without copying any data
     except zmq.Again:
-        pass
+        return False
+    return True
+
+
+def _shifted(data, offset):
+    ''' Data of one readout (see read_readouts) with the timestamps shifted by offset seconds '''
+    return [data[0], data[1] + offset, data[2] + offset] + list(data[3:])
 
 
 class PybarSim(object):
+    ''' Replay a pyBAR raw data file via ZeroMQ
+
+        speed is the replay speed relative to real time (e.g. 10 for
+        10 times faster), speed=0 replays as fast as possible. The raw data
+        is read in chunks of chunk_size readouts. Readouts that could not be
+        sent are counted in n_dropped, all readouts are numbered. The file
+        is replayed endlessly, the timestamps of every pass are shifted by
+        the duration of the previous passes, thus they keep increasing.
+    '''
 
-    def __init__(self, address='tcp://127.0.0.1:5678', delay=0.):
+    def __init__(self, address='tcp://127.0.0.1:5678', delay=0., speed=1., chunk_size=1000):
         self.delay = delay
+        self.speed = speed
+        self.chunk_size = chunk_size
         self.address = address
-        context = zmq.Context.instance()
-        self.socket = context.socket(zmq.PUB)  # publisher socket
-        self.socket.bind(self.address)
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.socket = publisher(self.address)
 
     def replay(self, raw_data_file):
         '''Sends the data of every read out (raw data and meta data)
@@ -61,59 +102,170 @@ class PybarSim(object):
         t1.start()
             
     def _send_data(self, raw_data_file):
+        offset = 0.  # timestamp shift of the pass
         while True:
+            first_timestamp, last_timestamp = None, None
             for data in self._get_data(raw_data_file):
-                time.sleep(self.delay)
-                send_data(socket=self.socket, data=data)
+                data = _shifted(data, offset)
+                if first_timestamp is None:
+                    first_timestamp = data[1]
+                last_timestamp = data[2] if last_timestamp is None else max(last_timestamp, data[2])
+                if self.delay:
+                    time.sleep(self.delay)
+                if send_data(socket=self.socket, data=data, sequence=self.n_sent + self.n_dropped):
+                    self.n_sent += 1
+                else:
+                    self.n_dropped += 1
+            if first_timestamp is not None:
+                offset += last_timestamp - first_timestamp
 
     def _get_data(self, raw_data_file):
         ''' Yield data of one readout
 
             Delay return if replay is too fast
         '''
-        with tb.open_file(raw_data_file, mode="r") as in_file_h5:
-            meta_data = in_file_h5.root.meta_data[:]
-            raw_data = in_file_h5.root.raw_data
-            n_readouts = meta_data.shape[0]
+        self.replay_start_time = time.time()
+        first_timestamp = None
+        for data in read_readouts(raw_data_file, self.chunk_size):
+            if first_timestamp is None:
+                first_timestamp = data[1]
+            # Wait if send too fast, especially needed when readout was
+            # stopped during data taking (e.g. for mask shifting).
+            # The replay follows the time line of the first readout
+            # to not accumulate delays.
+            if self.speed:
+                replay_time = (data[1] - first_timestamp) / self.speed
+                additional_delay = self.replay_start_time + replay_time - time.time()
+                if additional_delay > 0:
+                    time.sleep(additional_delay)
 
-            self.last_readout_time = time.time()
+            yield data
 
-            for i in range(n_readouts):
-                # Raw data indeces of readout
-                i_start = meta_data['index_start'][i]
-                i_stop = meta_data['index_stop'][i]
 
-                # Time stamps of readout
-                t_stop = meta_data[i]['timestamp_stop']
-                t_start = meta_data[i]['timestamp_start']
+def read_readouts(raw_data_file, chunk_size=1000):
+    ''' Yield the data of every readout of a pyBAR raw data file
+
+        The data is a list of raw data, timestamp start, timestamp stop and
+        readout error. The raw data is read in chunks of chunk_size readouts.
+    '''
+    with tb.open_file(raw_data_file, mode="r") as in_file_h5:
+        meta_data = in_file_h5.root.meta_data[:]
+        raw_data = in_file_h5.root.raw_data
+        n_readouts = meta_data.shape[0]
 
+        # Per readout columns are extracted once
+        index_start = meta_data['index_start'].astype(np.int64)
+        index_stop = meta_data['index_stop'].astype(np.int64)
+        timestamp_start = meta_data['timestamp_start']
+        timestamp_stop = meta_data['timestamp_stop']
+        error = meta_data['error']
+
+        for chunk_start in range(0, n_readouts, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, n_readouts)
+            # Raw data of all readouts in the chunk in one contiguous read
+            offset = index_start[chunk_start:chunk_stop].min()
+            raw_data_chunk = raw_data[offset:index_stop[chunk_start:chunk_stop].max()]
+
+            for i in range(chunk_start, chunk_stop):
                 # Create data of readout (raw data + meta data)
                 data = []
-                data.append(raw_data[i_start:i_stop])
-                data.extend((float(t_start),
-                             float(t_stop),
-                             int(meta_data[i]['error'])))
-
-                # Determine replay delays
-                if i == 0:  # Initialize on first readout
-                    self.last_timestamp_start = t_start
-                now = time.time()
-                delay = now - self.last_readout_time
-                additional_delay = t_start - self.last_timestamp_start - delay
-                if additional_delay > 0:
-                    # Wait if send too fast, especially needed when readout was
-                    # stopped during data taking (e.g. for mask shifting)
-                    time.sleep(additional_delay)
-                self.last_readout_time = time.time()
-                self.last_timestamp_start = t_start
-
+                data.append(raw_data_chunk[index_start[i] - offset:index_stop[i] - offset])
+                data.extend((float(timestamp_start[i]),
+                             float(timestamp_stop[i]),
+                             int(error[i])))
                 yield data
 
+
+class ReplayServer(object):
+    ''' Replay the pyBAR raw data files of several modules on one timeline
+
+        streams is a list of (raw data file, zmq address) of the modules,
+        the same file can be given for several modules. The readouts of all
+        files are merged by their start timestamp and sent from one
+        scheduler thread at the time given by the timestamp relative to the
+        first readout divided by speed (speed=0: as fast as possible).
+        Files are replayed again after the end if loop is set, the timestamps
+        of every pass are shifted by the duration of the previous passes to
+        keep the timeline increasing. Readouts that could not be sent are
+        counted per stream in n_dropped, the readouts of every stream are
+        numbered.
+    '''
+
+    def __init__(self, streams, speed=1., chunk_size=1000, loop=True):
+        self.streams = list(streams)
+        self.speed = speed
+        self.chunk_size = chunk_size
+        self.loop = loop
+        self.n_sent = [0] * len(self.streams)
+        self.n_dropped = [0] * len(self.streams)
+        self.sockets = {}  # one publisher per address
+        for _, address in self.streams:
+            if address not in self.sockets:
+                self.sockets[address] = publisher(address)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _merged_readouts(self):
+        ''' Stream index and data of the readouts of all streams ordered by start timestamp '''
+        def stream_readouts(i, raw_data_file):
+            for n, data in enumerate(read_readouts(raw_data_file, self.chunk_size)):
+                yield data[1], i, n, data  # stream and readout index keep equal timestamps in file order
+        merged = heapq.merge(*[stream_readouts(i, raw_data_file) for i, (raw_data_file, _) in enumerate(self.streams)])
+        for _, i, _, data in merged:
+            yield i, data
+
+    def start(self):
+        for raw_data_file, address in self.streams:
+            print('Replay %s at %s' % (raw_data_file, address))
+        self._thread = threading.Thread(target=self._send_data)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _send_data(self):
+        offset = 0.  # timestamp shift of the pass
+        while not self._stop.is_set():
+            start_time, first_timestamp, last_timestamp = time.time(), None, None
+            for i, data in self._merged_readouts():
+                if self._stop.is_set():
+                    return
+                data = _shifted(data, offset)
+                if first_timestamp is None:
+                    first_timestamp = data[1]
+                last_timestamp = data[2] if last_timestamp is None else max(last_timestamp, data[2])
+                # The replay follows the time line of the first readout to
+                # not accumulate delays
+                if self.speed:
+                    delay = start_time + (data[1] - first_timestamp) / self.speed - time.time()
+                    if delay > 0 and self._stop.wait(delay):
+                        return
+                if send_data(socket=self.sockets[self.streams[i][1]], data=data,
+                             sequence=self.n_sent[i] + self.n_dropped[i]):
+                    self.n_sent[i] += 1
+                else:
+                    self.n_dropped[i] += 1
+            if not self.loop:
+                return
+            if first_timestamp is not None:
+                offset += last_timestamp - first_timestamp
+
+
 if __name__ == '__main__':
-    import time
-    # Create data from two modules
-    sim_mod_1 = PybarSim(address='tcp://127.0.0.1:5678', delay=0.0)
-    sim_mod_2 = PybarSim(address='tcp://127.0.0.1:5679', delay=0.0)
-    sim_mod_1.replay('media/unit_test_data_5.h5')
-    time.sleep(2)
-    sim_mod_2.replay('media/unit_test_data_5.h5')
+    parser = argparse.ArgumentParser(description='Replay pyBAR raw data files of several modules on one timeline')
+    parser.add_argument('files', nargs='*', default=['media/unit_test_data_5.h5'] * 2, help='raw data file per module')
+    parser.add_argument('--addresses', nargs='+', default=['tcp://127.0.0.1:5678', 'tcp://127.0.0.1:5679'],
+                        help='zmq address per module')
+    parser.add_argument('--speed', type=float, default=1., help='replay speed factor, 0 is as fast as possible')
+    args = parser.parse_args()
+    if len(args.files) != len(args.addresses):
+        parser.error('%d files but %d addresses given, one address per file is needed'
+                     % (len(args.files), len(args.addresses)))
+    # Create data of all modules
+    server = ReplayServer(zip(args.files, args.addresses), speed=args.speed)
+    server.start()
+    while True:
+        time.sleep(1)
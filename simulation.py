@@ -0,0 +1,179 @@
+''' Monte Carlo FE-I4 raw data of a telescope for load tests
+
+    Straight tracks through all planes, cluster sizes and noise are
+    simulated for many events at once and converted to FE-I4 raw data
+    words (trigger word, data header with LVL1ID and BCID, data records,
+    without trigger words for self trigger). The readouts are published
+    with the pyBAR zmq protocol, e.g.:
+
+        python simulation.py --rate 10000 --tracks 2 --noise 1e-5
+'''
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+import pybario
+import replay
+
+
+class Simulation(object):
+    ''' Raw data generator of a telescope with planes at z (mm)
+
+        Per event tracks_per_event tracks (Poisson mean) cross the telescope
+        at a random position of the sensor area at the mean z. The polar
+        angles are distributed like cosmics (cos^2, 'cosmic') or like a beam
+        (Gaussian with angle_sigma in rad, 'beam'). Every track hit has on
+        average cluster_size pixels, noise_occupancy is the probability of
+        a noise hit per pixel and event. A readout contains
+        events_per_readout events. With self_trigger the raw data has no
+        trigger words like the self trigger scan of pyBAR, the events of
+        different planes are only combined by their BCID.
+    '''
+    def __init__(self, z=(0., 40.), rotations=None, tracks_per_event=1., angle_distribution='cosmic', angle_sigma=0.05,
+                 noise_occupancy=1e-5, cluster_size=1.5, events_per_readout=1, self_trigger=False, seed=None):
+        self.z = np.asarray(z, dtype=np.float64)
+        self.rotations = pybario.rotation_matrices(rotations if rotations is not None else np.zeros(self.z.shape[0]))
+        self.tracks_per_event = tracks_per_event
+        if angle_distribution not in ('cosmic', 'beam'):
+            raise ValueError('Unknown angle distribution %s' % angle_distribution)
+        self.angle_distribution = angle_distribution
+        self.angle_sigma = angle_sigma
+        self.noise_occupancy = noise_occupancy
+        self.cluster_size = cluster_size
+        self.events_per_readout = events_per_readout
+        self.self_trigger = self_trigger
+        self.rng = np.random.RandomState(seed)
+        self.n_events = 0  # events simulated so far, for the trigger number and LVL1ID
+        self.bunch_crossing = 0  # bunch crossing of the last event, for the BCID
+
+    def tracks(self, n_events):
+        ''' Event index and (T, n_planes, 2) float col, row of the tracks of n_events '''
+        n_tracks = self.rng.poisson(self.tracks_per_event, n_events)
+        events = np.repeat(np.arange(n_events), n_tracks)
+        size = np.array(pybario._PIXEL_PITCH) * (pybario._N_COLS, pybario._N_ROWS)
+        origins = (self.rng.uniform(size=(events.shape[0], 2)) - 0.5) * size
+        if self.angle_distribution == 'cosmic':
+            theta = np.arccos(self.rng.uniform(size=events.shape[0]) ** (1 / 3.))  # pdf ~ cos^2 sin
+        else:
+            theta = np.abs(self.rng.normal(scale=self.angle_sigma, size=events.shape[0]))
+        phi = self.rng.uniform(0, 2 * np.pi, size=events.shape[0])
+        slopes = np.tan(theta)[:, np.newaxis] * np.column_stack((np.cos(phi), np.sin(phi)))
+        # Track points in the telescope frame rotated into the sensor frames
+        points = origins[:, np.newaxis] + slopes[:, np.newaxis] * (self.z - self.z.mean())[:, np.newaxis]
+        points = np.einsum('pji,tpj->tpi', self.rotations, points)
+        return events, points / pybario._PIXEL_PITCH + pybario._SENSOR_CENTER
+
+    def plane_hits(self, events, col_rows, n_events):
+        ''' (N, 3) event, col, row pixel hits of one plane with clusters and noise '''
+        pixels = np.floor(col_rows + 0.5).astype(np.int64)
+        # Additional pixels of the clusters next to the track pixel
+        n_extra = self.rng.poisson(max(self.cluster_size - 1., 0.), events.shape[0])
+        extra_events = np.repeat(events, n_extra)
+        extra_pixels = np.repeat(pixels, n_extra, axis=0) + self.rng.randint(-1, 2, size=(extra_events.shape[0], 2))
+        # Noise hits
+        n_noise = self.rng.poisson(self.noise_occupancy * pybario._N_COLS * pybario._N_ROWS * n_events)
+        noise_events = self.rng.randint(0, n_events, n_noise)
+        noise_pixels = np.column_stack((self.rng.randint(1, pybario._N_COLS + 1, n_noise),
+                                        self.rng.randint(1, pybario._N_ROWS + 1, n_noise)))
+        hits = np.column_stack((np.concatenate((events, extra_events, noise_events)),
+                                np.concatenate((pixels, extra_pixels, noise_pixels))))
+        hits = hits[(hits[:, 1] >= 1) & (hits[:, 1] <= pybario._N_COLS) & (hits[:, 2] >= 1) & (hits[:, 2] <= pybario._N_ROWS)]
+        return hits[np.argsort(hits[:, 0], kind='stable')]
+
+    def raw_data(self, hits, n_events, bcids):
+        ''' Raw data words of n_events events and the word index where every event starts
+
+            Every event has a trigger word (not with self_trigger), one data
+            header with the next LVL1ID and the BCID of the event and the
+            data records of its hits.
+        '''
+        triggers = self.n_events + np.arange(n_events)
+        n_headers = 1 if self.self_trigger else 2  # words before the data records
+        counts = np.bincount(hits[:, 0], minlength=n_events)
+        starts = np.zeros(n_events, dtype=np.int64)
+        starts[1:] = np.cumsum(counts + n_headers)[:-1]
+        words = np.empty(shape=n_events * n_headers + hits.shape[0], dtype=np.uint32)
+        if not self.self_trigger:
+            words[starts] = 0x80000000 | (triggers & 0x7FFFFFFF)
+        words[starts + n_headers - 1] = 0x00E90000 | ((triggers & 0x1F) << 10) | bcids
+        first_hit = np.cumsum(counts) - counts  # index of the first hit of every event
+        hit_index = starts[hits[:, 0]] + n_headers + np.arange(hits.shape[0]) - first_hit[hits[:, 0]]
+        tots = self.rng.randint(0, 14, hits.shape[0])
+        words[hit_index] = (hits[:, 1] << 17) | (hits[:, 2] << 8) | (tots << 4) | 0xF  # no second hit
+        return words, starts
+
+    def readouts(self, n_readouts):
+        ''' Per plane a list with the raw data of n_readouts readouts '''
+        n_events = n_readouts * self.events_per_readout
+        events, col_rows = self.tracks(n_events)
+        # All planes see the same bunch crossing, events are a few bunch crossings apart
+        bunch_crossings = self.bunch_crossing + np.cumsum(self.rng.randint(1, 64, n_events))
+        self.bunch_crossing = bunch_crossings[-1]
+        plane_readouts = []
+        for i in range(self.z.shape[0]):
+            words, starts = self.raw_data(self.plane_hits(events, col_rows[:, i], n_events), n_events,
+                                          bunch_crossings & 0x3FF)
+            plane_readouts.append(np.split(words, starts[self.events_per_readout::self.events_per_readout]))
+        self.n_events += n_events
+        return plane_readouts
+
+    def publish(self, addresses, readout_rate=1000., n_readouts=None, block_size=1000):
+        ''' Send readouts to the addresses of all planes
+
+            readout_rate is the number of readouts per second of every plane
+            (0: as fast as possible). Sends forever if n_readouts is None.
+            Readouts are simulated in blocks of block_size readouts. Returns
+            per plane the number of readouts that were dropped because the
+            send queue of a subscriber was full (see replay.publisher), the
+            receiver sees them as gaps of the readout sequence numbers.
+        '''
+        sockets = [replay.publisher(address) for address in addresses]
+        time.sleep(0.5)  # wait for subscribers
+        n_dropped = [0] * len(sockets)
+        n_sent = 0
+        start_time = time.time()
+        while n_readouts is None or n_sent < n_readouts:
+            block = block_size if n_readouts is None else min(block_size, n_readouts - n_sent)
+            plane_readouts = self.readouts(block)
+            for k in range(block):
+                timestamp = n_sent / float(readout_rate) if readout_rate else time.time() - start_time
+                if readout_rate:
+                    delay = start_time + timestamp - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                for i, socket in enumerate(sockets):
+                    if not replay.send_data(socket, (plane_readouts[i][k], start_time + timestamp, start_time + timestamp, 0),
+                                            sequence=n_sent):
+                        n_dropped[i] += 1
+                n_sent += 1
+        for socket in sockets:
+            socket.close()
+        return n_dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish Monte Carlo FE-I4 data of all modules of a geometry file')
+    parser.add_argument('geometry_file', nargs='?', default='geometry.json', help='telescope geometry (json)')
+    parser.add_argument('--rate', type=float, default=1000., help='readouts per second and module, 0 is as fast as possible')
+    parser.add_argument('--readouts', type=int, help='number of readouts, default is endless')
+    parser.add_argument('--tracks', type=float, default=1., help='mean tracks per event')
+    parser.add_argument('--angles', choices=('cosmic', 'beam'), default='cosmic', help='angular distribution')
+    parser.add_argument('--sigma', type=float, default=0.05, help='beam divergence in rad')
+    parser.add_argument('--noise', type=float, default=1e-5, help='noise occupancy per pixel and event')
+    parser.add_argument('--cluster-size', type=float, default=1.5, help='mean pixels per track hit')
+    parser.add_argument('--events', type=int, default=1, help='events per readout')
+    parser.add_argument('--self-trigger', action='store_true', help='no trigger words, events are combined by BCID')
+    parser.add_argument('--seed', type=int, help='random seed')
+    args = parser.parse_args()
+
+    with open(args.geometry_file) as in_file:
+        modules = json.load(in_file)['modules']
+    simulation = Simulation(z=[m['z'] for m in modules], rotations=[m.get('rotation', 0.) for m in modules],
+                            tracks_per_event=args.tracks, angle_distribution=args.angles, angle_sigma=args.sigma,
+                            noise_occupancy=args.noise, cluster_size=args.cluster_size, events_per_readout=args.events,
+                            self_trigger=args.self_trigger, seed=args.seed)
+    n_dropped = simulation.publish([m['address'] for m in modules], readout_rate=args.rate, n_readouts=args.readouts)
+    print('Readouts dropped by the publisher per module (full send queue)', n_dropped)